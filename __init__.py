@@ -3,15 +3,32 @@
 from trytond.pool import Pool
 from . import work
 from . import default_rule
+from . import recipient_policy
 from . import summary_contacts
 from . import user
+from . import ir
+from . import party
+from . import company
 
 def register():
     Pool.register(
         work.WorkParty,
         work.Work,
+        work.WorkRecipient,
+        work.WorkMailChange,
+        work.WorkMailLog,
+        work.ApplyDefaultRulesStart,
         default_rule.ContactParty,
         default_rule.DefaultRule,
+        recipient_policy.RecipientPolicy,
         summary_contacts.SummaryContacts,
         user.User,
+        ir.Cron,
+        party.Party,
+        party.Relation,
+        party.ContactMechanism,
+        company.Employee,
         module='project_contact', type_='model')
+    Pool.register(
+        work.ApplyDefaultRules,
+        module='project_contact', type_='wizard')
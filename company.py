@@ -0,0 +1,36 @@
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Employee']
+
+
+class Employee(metaclass=PoolMeta):
+    __name__ = 'company.employee'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        WorkParty = pool.get('project.work-party.party')
+        WorkRecipient = pool.get('project.work.recipient')
+        super().on_modification(mode, records, field_names=field_names)
+        WorkParty._allowed_contacts_cache.clear()
+        if mode in {'create', 'write'}:
+            WorkRecipient.update_parties([e.party.id for e in records])
+
+    @classmethod
+    def on_write(cls, employees, values):
+        pool = Pool()
+        WorkRecipient = pool.get('project.work.recipient')
+        callback = super().on_write(employees, values)
+        if 'party' in values:
+            parties = [e.party.id for e in employees]
+            callback.append(lambda: WorkRecipient.update_parties(parties))
+        return callback
+
+    @classmethod
+    def on_delete(cls, employees):
+        pool = Pool()
+        WorkRecipient = pool.get('project.work.recipient')
+        callback = super().on_delete(employees)
+        parties = [e.party.id for e in employees]
+        callback.append(lambda: WorkRecipient.update_parties(parties))
+        return callback
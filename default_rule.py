@@ -1,5 +1,7 @@
+from trytond.cache import Cache
 from trytond.model import (ModelSQL, ModelView, MatchMixin, fields,
     sequence_ordered)
+from trytond.pool import Pool
 
 __all__ = ['DefaultRule', 'ContactParty']
 
@@ -13,6 +15,13 @@ class ContactParty(ModelSQL):
     party = fields.Many2One('party.party', 'Party', required=True,
         ondelete='CASCADE')
 
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        DefaultRule = pool.get('project.work.default_rule')
+        super().on_modification(mode, records, field_names=field_names)
+        DefaultRule._rules_cache.clear()
+
 
 class DefaultRule(sequence_ordered(), MatchMixin, ModelSQL, ModelView):
     'Default Rule'
@@ -21,12 +30,90 @@ class DefaultRule(sequence_ordered(), MatchMixin, ModelSQL, ModelView):
     project = fields.Many2One('project.work', 'Project')
     contacts = fields.Many2Many('project.work.default_rule-party.party', 'rule',
              'party','Contacts')
+    exclude = fields.Boolean('Exclude',
+        help='Remove the contacts from the ones of the other matching rules.')
+    stop = fields.Boolean('Stop',
+        help='Do not evaluate the following rules when this one matches.')
+    _rules_cache = Cache('project.work.default_rule.rules', context=False)
 
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        super().on_modification(mode, records, field_names=field_names)
+        cls._rules_cache.clear()
+
+    @classmethod
+    def get_rules_index(cls):
+        '''
+        Return a dictionary with the project id (None for the rules without
+        project) as key and the list of (position, rule id, contact ids,
+        exclude, stop) as value, where position is the rank of the rule in the
+        search order.
+        '''
+        index = cls._rules_cache.get(None)
+        if index is not None:
+            return index
+        rules = cls.search([])
+        index = {}
+        values = {r['id']: r for r in cls.read([r.id for r in rules],
+                ['project', 'contacts', 'exclude', 'stop'])}
+        for position, rule in enumerate(rules):
+            value = values[rule.id]
+            index.setdefault(value['project'], []).append(
+                (position, rule.id, tuple(value['contacts']),
+                    bool(value['exclude']), bool(value['stop'])))
+        cls._rules_cache.set(None, index)
+        return index
 
     @classmethod
     def compute(cls, pattern):
-        contacts = []
-        for rule in cls.search([]):
-            if rule.match(pattern):
-                contacts += rule.contacts
-        return contacts
+        '''
+        Return the contacts of the rules matching the pattern without
+        duplicates.
+
+        The rules of the ancestors of the project are inherited: the rules
+        of the project and the ones without project come first, sorted by
+        sequence, followed by the rules of each ancestor, nearest first.
+        The contacts of the exclude rules are removed from the result and no
+        rule is evaluated after a matching stop rule.
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        Work = pool.get('project.work')
+
+        index = cls.get_rules_index()
+        project = pattern.get('project')
+        ancestors = [project]
+        if project is not None:
+            ancestors = Work.get_ancestors([project]).get(project, ancestors)
+
+        candidates = []
+        for rank, ancestor in enumerate(ancestors):
+            rules = []
+            if ancestor is not None:
+                rules.extend(index.get(ancestor, []))
+            if not rank:
+                rules.extend(index.get(None, []))
+            candidates.extend(sorted((rank,) + rule for rule in rules))
+
+        other_keys = set(pattern) - {'project'}
+        rules = cls.browse([c[2] for c in candidates]) if other_keys else []
+
+        contacts = {}
+        excluded = set()
+        for i, (rank, _, _, party_ids, exclude, stop) in enumerate(
+                candidates):
+            if (other_keys
+                    and not rules[i].match(
+                        dict(pattern, project=ancestors[rank]))):
+                continue
+            if exclude:
+                excluded.update(party_ids)
+                for party_id in party_ids:
+                    contacts.pop(party_id, None)
+            else:
+                for party_id in party_ids:
+                    if party_id not in excluded:
+                        contacts.setdefault(party_id)
+            if stop:
+                break
+        return Party.browse(list(contacts))
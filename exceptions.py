@@ -0,0 +1,7 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model.exceptions import ValidationError
+
+
+class DomainError(ValidationError):
+    pass
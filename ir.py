@@ -0,0 +1,17 @@
+from trytond.pool import PoolMeta
+
+__all__ = ['Cron']
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.extend([
+                ('project.work.mail_change|send_pending',
+                    "Send Pending Work Changes"),
+                ('project.work.mail_change|send_digest',
+                    "Send Work Changes Digest"),
+                ])
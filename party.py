@@ -0,0 +1,55 @@
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Party', 'Relation', 'ContactMechanism']
+
+
+class Party(metaclass=PoolMeta):
+    __name__ = 'party.party'
+
+    employees = fields.One2Many('company.employee', 'party', 'Employees',
+        readonly=True)
+    reverse_relations = fields.One2Many('party.relation.all', 'to',
+        'Reverse Relations', readonly=True)
+
+
+class Relation(metaclass=PoolMeta):
+    __name__ = 'party.relation'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        WorkParty = pool.get('project.work-party.party')
+        super().on_modification(mode, records, field_names=field_names)
+        WorkParty._allowed_contacts_cache.clear()
+
+
+class ContactMechanism(metaclass=PoolMeta):
+    __name__ = 'party.contact_mechanism'
+
+    @classmethod
+    def on_modification(cls, mode, mechanisms, field_names=None):
+        pool = Pool()
+        WorkRecipient = pool.get('project.work.recipient')
+        super().on_modification(mode, mechanisms, field_names=field_names)
+        if mode in {'create', 'write'}:
+            WorkRecipient.update_parties([m.party.id for m in mechanisms])
+
+    @classmethod
+    def on_write(cls, mechanisms, values):
+        pool = Pool()
+        WorkRecipient = pool.get('project.work.recipient')
+        callback = super().on_write(mechanisms, values)
+        if 'party' in values:
+            parties = [m.party.id for m in mechanisms]
+            callback.append(lambda: WorkRecipient.update_parties(parties))
+        return callback
+
+    @classmethod
+    def on_delete(cls, mechanisms):
+        pool = Pool()
+        WorkRecipient = pool.get('project.work.recipient')
+        callback = super().on_delete(mechanisms)
+        parties = [m.party.id for m in mechanisms]
+        callback.append(lambda: WorkRecipient.update_parties(parties))
+        return callback
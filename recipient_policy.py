@@ -0,0 +1,116 @@
+from trytond.cache import Cache
+from trytond.i18n import gettext
+from trytond.model import ModelSQL, ModelView, fields, sequence_ordered
+from trytond.pool import Pool
+from trytond.pyson import PYSONDecoder
+
+from .exceptions import DomainError
+
+__all__ = ['RecipientPolicy']
+
+
+class RecipientPolicy(sequence_ordered(), ModelSQL, ModelView):
+    'Recipient Policy'
+    __name__ = 'project.work.recipient_policy'
+
+    project = fields.Many2One('project.work', 'Project',
+        help='The policy applies to the project and its descendants.\n'
+        'Leave empty to apply it to the works without project policy.')
+    contacts = fields.Selection([
+            ('employees', 'Employees'),
+            ('all', 'All'),
+            ], 'Contacts', required=True,
+        help='The work contacts that receive the mails.')
+    domain = fields.Char('Domain',
+        help='PYSON encoded domain on the work contacts that receive the '
+        'mails.')
+    _policies_cache = Cache('project.work.recipient_policy.policies',
+        context=False)
+
+    @staticmethod
+    def default_contacts():
+        return 'employees'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        super().on_modification(mode, records, field_names=field_names)
+        cls._policies_cache.clear()
+
+    @classmethod
+    def validate_fields(cls, policies, field_names):
+        super().validate_fields(policies, field_names)
+        cls.check_domain(policies, field_names)
+
+    @classmethod
+    def check_domain(cls, policies, field_names=None):
+        'Check the domain of the policies is a valid work contacts domain'
+        WorkParty = Pool().get('project.work-party.party')
+        if field_names and 'domain' not in field_names:
+            return
+        for policy in policies:
+            if not policy.domain:
+                continue
+            try:
+                domain = PYSONDecoder().decode(policy.domain)
+                if not isinstance(domain, list):
+                    raise ValueError
+                WorkParty.search(domain, limit=0)
+            except Exception as exception:
+                raise DomainError(gettext(
+                        'project_contact.msg_recipient_policy_invalid_domain',
+                        policy=policy.rec_name)) from exception
+
+    @classmethod
+    def get_policies_index(cls):
+        '''
+        Return a dictionary with the project id (None for the policies
+        without project) as key and the id of its first policy as value
+        '''
+        index = cls._policies_cache.get(None)
+        if index is not None:
+            return index
+        index = {}
+        for policy in cls.search([]):
+            index.setdefault(
+                policy.project.id if policy.project else None, policy.id)
+        cls._policies_cache.set(None, index)
+        return index
+
+    @classmethod
+    def get_policies(cls, work_ids):
+        '''
+        Return a dictionary with the work id as key and the policy of the
+        nearest of the work and its ancestors with a policy as value, or the
+        first policy without project or None
+        '''
+        Work = Pool().get('project.work')
+        index = cls.get_policies_index()
+        ancestors = {}
+        if set(index) - {None}:
+            ancestors = Work.get_ancestors(work_ids)
+        result = {}
+        for work_id in work_ids:
+            policy_id = next((index[a] for a in ancestors.get(work_id, [])
+                    if a in index), index.get(None))
+            result[work_id] = (
+                cls(policy_id) if policy_id is not None else None)
+        return result
+
+    @classmethod
+    def get_default_domain(cls):
+        'Return the domain of the recipients of the works without policy'
+        pool = Pool()
+        Employee = pool.get('company.employee')
+        employee = Employee.__table__()
+        return [
+            ('party', 'in', employee.select(employee.party)),
+            ]
+
+    def get_domain(self):
+        'Return the domain on the work contacts that receive the mails'
+        domain = []
+        if self.contacts == 'employees':
+            domain.extend(self.get_default_domain())
+        if self.domain:
+            domain.append(PYSONDecoder().decode(self.domain))
+        return domain
@@ -0,0 +1,305 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Rendering of the work mails from plain data.
+
+The functions do not use the pool nor the transaction: the values are
+already converted for display (the rec_name of the Many2One, the formatted
+dates) so they can be tested and profiled without a database.
+'''
+import difflib
+import html
+import time
+
+__all__ = ['mail_title', 'render_text', 'render_text_diff',
+    'render_text_change', 'render_text_summary', 'render_value_change',
+    'render_value_summary', 'render_subfield', 'render_one2many_change',
+    'render_body', 'render_change', 'render_summary']
+
+HTML = u'''<html><head>
+            <meta http-equiv="Content-Type" content="text/html;charset=utf-8">
+            </head>
+            <body style="font-family: courier">%s</body>
+            </html>'''
+MAIL_HEADER = (u'<div style="background: #EEEEEE; padding-left: 10px; '
+    'padding-bottom: 10px">'
+    '<a href="%(url)s">'
+    '<h2 style="margin: 0px 0px 0px 0px; '
+    'padding: 0px 0px 0px 0px;">%(name)s</h2>'
+    '</a>')
+MAIL_FOOTER = (u'<br>'
+    '<small>'
+    '%(operation)s by %(write_user)s on %(write_date)s'
+    '</small>'
+    '<br/>\n'
+    '</div>')
+LINE_SEPARATOR = u'<br><hr style="border-top: 1px dashed;">'
+
+
+def mail_title(name):
+    'Return the title of the field name'
+    return ' '.join(x.capitalize() for x in name.split('_'))
+
+
+def render_text(text):
+    'Return the escaped lines of text'
+    return [html.escape(line) for line in text.splitlines(1)]
+
+
+class DiffTimeout(Exception):
+    pass
+
+
+class BoundedSequenceMatcher(difflib.SequenceMatcher):
+    'SequenceMatcher that raises DiffTimeout when aligning after deadline'
+
+    def __init__(self, a, b, deadline):
+        self.deadline = deadline
+        super().__init__(None, a, b)
+
+    def find_longest_match(self, *args, **kwargs):
+        if time.monotonic() > self.deadline:
+            raise DiffTimeout
+        return super().find_longest_match(*args, **kwargs)
+
+
+def render_text_diff(old, new, max_lines=500, max_hunks=20, timeout=1,
+        match_lines=20000):
+    '''
+    Return the HTML lines of the diff between the old and new text.
+    The diff of texts longer than max_lines is bounded in size and time and
+    ends with the number of changed lines that are not shown.
+    '''
+    old = old.splitlines(1)
+    new = new.splitlines(1)
+    omitted = 0
+    if len(old) + len(new) <= max_lines:
+        diffs = [d for d in difflib.unified_diff(old, new, n=3)
+            if not (d.startswith('@') or d.startswith('+++')
+                or d.startswith('---'))]
+    else:
+        diffs, omitted = bounded_diff(old, new, max_lines=max_lines,
+            max_hunks=max_hunks, timeout=timeout, match_lines=match_lines)
+
+    body = []
+    for diff in diffs:
+        diff = html.escape(diff)
+        if diff.startswith('-'):
+            body.append(u'<font color="red">%s</font>' % diff.rstrip('\n'))
+        elif diff.startswith('+'):
+            body.append(u'<font color="green">%s</font>' % diff.rstrip('\n'))
+        else:
+            body.append(diff.rstrip('\n'))
+    if omitted:
+        body.append(u'<i>%s more lines changed</i>' % omitted)
+    return body
+
+
+def bounded_diff(old, new, context=3, max_lines=500, max_hunks=20,
+        timeout=1, match_lines=20000):
+    '''
+    Return the unified diff lines, without headers, between the old and new
+    lists of lines and the number of changed lines omitted to stay under
+    max_lines, max_hunks and timeout.
+    Above match_lines or when the alignment exceeds timeout, the texts are
+    compared without alignment.
+    '''
+    start = time.monotonic()
+    size = min(len(old), len(new))
+    prefix = 0
+    while prefix < size and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < size - prefix
+            and old[-1 - suffix] == new[-1 - suffix]):
+        suffix += 1
+    begin = max(prefix - context, 0)
+    end = max(suffix - context, 0)
+    old = old[begin:len(old) - end]
+    new = new[begin:len(new) - end]
+
+    groups = None
+    if len(old) + len(new) <= match_lines:
+        # Compare the hashes as they are faster to compare than the lines
+        matcher = BoundedSequenceMatcher(
+            [hash(l) for l in old], [hash(l) for l in new], start + timeout)
+        try:
+            groups = list(matcher.get_grouped_opcodes(context))
+        except DiffTimeout:
+            pass
+    if groups is None:
+        # Show the lines that are only in one of the texts as a single hunk
+        old_lines, new_lines = set(old), set(new)
+        removed = [l for l in old if l not in new_lines]
+        added = [l for l in new if l not in old_lines]
+        old, new = removed, added
+        groups = [[('replace', 0, len(removed), 0, len(added))]]
+
+    diffs = []
+    omitted = 0
+    for count, group in enumerate(groups):
+        # The first hunk is always shown as it is bounded by max_lines
+        if (count >= max_hunks
+                or len(diffs) >= max_lines
+                or (count and time.monotonic() - start > timeout)):
+            omitted += sum(i2 - i1 + j2 - j1
+                for tag, i1, i2, j1, j2 in group if tag != 'equal')
+            continue
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                lines = [' ' + l for l in old[i1:i2]]
+            else:
+                lines = ([('-' + l) for l in old[i1:i2]]
+                    + [('+' + l) for l in new[j1:j2]])
+            available = max(max_lines - len(diffs), 0)
+            diffs.extend(lines[:available])
+            if tag != 'equal':
+                omitted += max(len(lines) - available, 0)
+    return diffs, omitted
+
+
+def render_text_change(title, old, new, **options):
+    '''
+    Return the HTML lines of the change of a text.
+    The options are passed to render_text_diff.
+    '''
+    return ([u'<br><b>{}</b>:'.format(title)]
+        + render_text_diff(old or '', new or '', **options))
+
+
+def render_text_summary(title, text):
+    'Return the HTML lines of a text'
+    return [u'<b>{}</b>:'.format(title)] + render_text(text or '')
+
+
+def render_value_change(title, value, old=None, has_old=False):
+    'Return the HTML lines of the change of a value'
+    body = [u'<b>{}</b>:'.format(title)]
+    if has_old:
+        body.append(u'<font color="red">- {} </font>'.format(old))
+    body.append(u'<font color="green"> + {} </font>'.format(value))
+    return body
+
+
+def render_value_summary(title, value):
+    'Return the HTML lines of a value'
+    return [u'<b>{}</b>: {}'.format(title, value)]
+
+
+def render_subfield(title, kind, value):
+    '''
+    Return the HTML lines of the value of a One2Many line where kind is
+    'text', 'datetime' or 'value'
+    '''
+    if kind == 'text':
+        return render_text_summary(title, value)
+    elif kind == 'datetime':
+        value = value.strftime('%Y-%m-%d %H:%M') if value else '/'
+    return [u'<b>{}</b>: {}'.format(title, value)]
+
+
+def render_one2many_change(rows, subfields, max_lines=100):
+    '''
+    Yield the HTML lines of the One2Many rows.
+    subfields is the list of (name, title, kind) of the values of the rows.
+    The rows are the values of the created lines or, for the other lines,
+    have also the _action and the _rec_name keys. The rows with an _omitted
+    key count the lines not recorded. Above max_lines, the rows are only
+    counted at the end.
+    '''
+    shown = omitted = 0
+    for values in rows:
+        if '_omitted' in values:
+            omitted += values['_omitted']
+            continue
+        if shown >= max_lines:
+            omitted += 1
+            continue
+        shown += 1
+        action = values.get('_action', 'create')
+        if action == 'create':
+            for name, title, kind in subfields:
+                yield from render_subfield(title, kind, values.get(name))
+        elif action == 'write':
+            yield u'<b>Updated</b>: {}'.format(values.get('_rec_name'))
+            for name, title, kind in subfields:
+                if name in values:
+                    yield from render_subfield(title, kind, values[name])
+        elif action in {'delete', 'remove'}:
+            yield u'<font color="red">- {} </font>'.format(
+                values.get('_rec_name'))
+        else:
+            yield u'<font color="green"> + {} </font>'.format(
+                values.get('_rec_name'))
+        yield LINE_SEPARATOR
+    if omitted:
+        yield u'<i>%s more lines changed</i>' % omitted
+
+
+def render_body(name, url, lines, operation, user, date):
+    'Return the HTML block of a work with the lines of its fields'
+    body = [MAIL_HEADER % {
+            'url': url,
+            'name': name,
+            }]
+    body.extend(lines)
+    body.append(MAIL_FOOTER % {
+            'operation': operation,
+            'write_user': user,
+            'write_date': date,
+            })
+    return u'<br/>\n'.join(body)
+
+
+def render_change(name, url, fields, values, old_values=None,
+        one2many_values=None, user='', date='/', max_rows=100,
+        **options):
+    '''
+    Return the HTML block of the changes of a work.
+    fields is the list of (name, kind, subfields) of the fields to render
+    where kind is 'text', 'one2many' or 'value' and subfields the list of
+    (name, kind) of the One2Many rows.
+    values and old_values are dictionaries of the new and old display values
+    by field name, old_values being None for a new work.
+    one2many_values is a dictionary of the rows by One2Many field name, above
+    max_rows the rows are only counted.
+    The options are passed to render_text_diff.
+    '''
+    operation = 'Created' if old_values is None else 'Updated'
+    if old_values is None:
+        old_values = {}
+    if one2many_values is None:
+        one2many_values = {}
+    lines = []
+    for field, kind, subfields in fields:
+        title = mail_title(field)
+        if kind == 'text':
+            lines.extend(render_text_change(title,
+                    old_values.get(field), values.get(field), **options))
+        elif kind == 'one2many':
+            lines.extend(render_one2many_change(
+                    one2many_values.get(field, []),
+                    [(s, mail_title(s), k) for s, k in subfields or []],
+                    max_lines=max_rows))
+        else:
+            lines.extend(render_value_change(title, values.get(field),
+                    old_values.get(field), field in old_values))
+    return render_body(name, url, lines, operation, user, date)
+
+
+def render_summary(name, url, fields, values, user='', date='/'):
+    '''
+    Return the HTML of the summary of a work.
+    fields is the list of (name, kind) of the fields to render where kind is
+    'text' or 'value' and values the dictionary of the display values by
+    field name.
+    '''
+    lines = []
+    for field, kind in fields:
+        title = mail_title(field)
+        if kind == 'text':
+            lines.extend(render_text_summary(title, values.get(field)))
+        else:
+            lines.extend(render_value_summary(title, values.get(field)))
+    return HTML % render_body(' %s ' % name, url, lines, 'Closed', user,
+        date)
@@ -0,0 +1,118 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import smtplib
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+
+from trytond.config import config
+from trytond.sendmail import (SMTPDataManager, get_smtp_server,
+    sendmail_transactional as _sendmail_transactional)
+
+__all__ = ['sendmail_transactional', 'PooledSMTPDataManager']
+
+logger = logging.getLogger(__name__)
+
+SMTP_URI = config.get('project_contact', 'smtp_uri')
+SMTP_CONCURRENCY = config.getint('project_contact', 'smtp_concurrency',
+    default=1)
+SMTP_RETRY = config.getint('project_contact', 'smtp_retry', default=3)
+SMTP_BACKOFF = config.getfloat('project_contact', 'smtp_backoff', default=0.5)
+
+
+def sendmail_transactional(from_addr, to_addrs, msg, transaction=None):
+    '''
+    Queue the mail to be delivered at the commit of the transaction with the
+    other mails of the module over the pooled connections
+    '''
+    _sendmail_transactional(from_addr, to_addrs, msg, transaction=transaction,
+        datamanager=PooledSMTPDataManager(SMTP_URI,
+            concurrency=SMTP_CONCURRENCY, retry=SMTP_RETRY,
+            backoff=SMTP_BACKOFF))
+
+
+class PooledSMTPDataManager(SMTPDataManager):
+    '''
+    Deliver all the mails of a transaction over at most concurrency reused
+    connections, retrying the temporary failures with an exponential backoff
+    '''
+
+    def __init__(self, uri=None, strict=False, concurrency=1, retry=3,
+            backoff=0.5):
+        super(PooledSMTPDataManager, self).__init__(uri=uri, strict=strict)
+        self.concurrency = max(concurrency, 1)
+        self.retry = max(retry, 0)
+        self.backoff = backoff
+
+    def __eq__(self, other):
+        if not isinstance(other, PooledSMTPDataManager):
+            return NotImplemented
+        return ((self.uri, self.strict, self.concurrency, self.retry,
+                self.backoff) == (other.uri, other.strict, other.concurrency,
+                other.retry, other.backoff))
+
+    def __hash__(self):
+        return hash((self.uri, self.strict))
+
+    def tpc_finish(self, trans):
+        if self._server is not None:
+            size = min(self.concurrency, len(self.queue)) or 1
+            batches = [self.queue[i::size] for i in range(size)]
+            servers = [self._server] + [None] * (size - 1)
+            if size > 1:
+                with ThreadPoolExecutor(max_workers=size) as executor:
+                    servers = list(executor.map(
+                            self.deliver, servers, batches))
+            else:
+                servers = [self.deliver(self._server, batches[0])]
+            for server in servers:
+                if server is not None:
+                    try:
+                        server.quit()
+                    except smtplib.SMTPException:
+                        server.close()
+        self._finish()
+
+    def connect(self):
+        return get_smtp_server(self.uri, strict=self.strict)
+
+    def deliver(self, server, messages):
+        '''
+        Send the messages over the server and return the server connected at
+        the end or None
+        '''
+        for from_addr, to_addrs, msg in messages:
+            if 'Date' not in msg:
+                msg['Date'] = formatdate()
+            for attempt in range(self.retry + 1):
+                if attempt:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                if server is None:
+                    server = self.connect()
+                    if server is None:
+                        continue
+                try:
+                    senderrs = server.send_message(msg, from_addr, to_addrs)
+                except smtplib.SMTPServerDisconnected:
+                    server = None
+                    if attempt < self.retry:
+                        continue
+                    logger.error('fail to send email', exc_info=True)
+                except smtplib.SMTPResponseException as e:
+                    if attempt < self.retry and 400 <= e.smtp_code <= 499:
+                        if e.smtp_code == 421:
+                            server.close()
+                            server = None
+                        continue
+                    logger.error('fail to send email', exc_info=True)
+                except Exception:
+                    logger.error('fail to send email', exc_info=True)
+                else:
+                    if senderrs:
+                        logger.warning('fail to send email to %s', senderrs)
+                break
+            else:
+                logger.error('fail to send email to %s', to_addrs)
+        return server
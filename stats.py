@@ -0,0 +1,140 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from weakref import WeakKeyDictionary
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['operation', 'stage', 'incr', 'get_totals', 'count_queries']
+
+logger = logging.getLogger(__name__)
+
+STATS = config.getboolean('project_contact', 'stats', default=False)
+
+_operations = WeakKeyDictionary()
+_totals = defaultdict(float)
+_lock = threading.Lock()
+
+
+class CountingCursor(object):
+    'Cursor proxy that counts the executed queries'
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter[0] += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection(object):
+    'Connection proxy that returns counting cursors'
+
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+@contextmanager
+def count_queries():
+    '''
+    Count the queries executed in the transaction and yield a list whose
+    first item is the number of queries
+    '''
+    transaction = Transaction()
+    counter = [0]
+    connection = transaction.connection
+    transaction.connection = CountingConnection(connection, counter)
+    try:
+        yield counter
+    finally:
+        transaction.connection = connection
+
+
+@contextmanager
+def operation(name):
+    '''
+    Measure the operation name: its seconds, SQL queries and the stages and
+    counters recorded inside it.
+    The nested operations are accounted in the outermost one.
+    Nothing is measured unless the stats option is set.
+    '''
+    transaction = Transaction()
+    if not STATS or transaction in _operations:
+        yield
+        return
+    stats = _operations[transaction] = defaultdict(float)
+    start = time.perf_counter()
+    try:
+        with count_queries() as queries:
+            yield
+    finally:
+        del _operations[transaction]
+        stats['seconds'] = time.perf_counter() - start
+        stats['queries'] = queries[0]
+        logger.info('%s: %s', name, ' '.join('%s=%s' % (k,
+                    round(v, 6) if isinstance(v, float) else v)
+                for k, v in sorted(stats.items())))
+        with _lock:
+            _totals[name + '.count'] += 1
+            for key, value in stats.items():
+                _totals['%s.%s' % (name, key)] += value
+
+
+@contextmanager
+def stage(name):
+    'Add the seconds spent in the stage name to the current operation'
+    stats = _operations.get(Transaction()) if STATS else None
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats[name + '.seconds'] += time.perf_counter() - start
+        stats[name + '.count'] += 1
+
+
+def incr(name, value=1):
+    'Increment the counter name of the current operation by value'
+    if STATS:
+        stats = _operations.get(Transaction())
+        if stats is not None:
+            stats[name] += value
+
+
+def get_totals():
+    '''
+    Return a dictionary with the totals of the operations measured by the
+    process since it started
+    '''
+    with _lock:
+        return dict(_totals)
@@ -1,4 +1,9 @@
-from trytond.model import (ModelSQL, ModelView, MatchMixin, fields)
+from sql import Null
+
+from trytond.model import (ModelSQL, ModelView, MatchMixin, Index, fields)
+from trytond.pool import Pool
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 
 __all__ = ['SummaryContacts']
 
@@ -10,17 +15,69 @@ class SummaryContacts(MatchMixin, ModelSQL, ModelView):
     project = fields.Many2One('project.work', 'Project')
     contacts = fields.Many2One('party.party', 'Contacts')
 
+    @classmethod
+    def __setup__(cls):
+        super(SummaryContacts, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.project, Index.Equality())))
+
+    @classmethod
+    def get_emails(cls, party_ids):
+        '''
+        Return a dictionary with the party id as key and its e-mail as value
+        '''
+        Party = Pool().get('party.party')
+        return {p['id']: p['email']
+            for p in Party.read(list(set(party_ids)), ['email'])}
+
     @classmethod
     def get_mail(cls):
-        emails = []
-        for contact in cls.search([]):
-            emails.append(contact.contacts.email)
-        return emails
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        cursor.execute(*table.select(table.contacts,
+                where=table.contacts != Null,
+                order_by=table.id))
+        party_ids = [p for p, in cursor]
+        emails = cls.get_emails(party_ids)
+        return list(dict.fromkeys(emails[p] for p in party_ids if emails[p]))
 
     @classmethod
     def compute(cls, pattern):
-        emails = []
-        for contact in cls.search([]):
-            if contact.match(pattern):
-                emails.append(contact.contacts.email)
-        return emails
+        return cls.compute_patterns([pattern])[0]
+
+    @classmethod
+    def compute_patterns(cls, patterns):
+        '''
+        Return for each pattern the list of e-mails of the matching summary
+        contacts without duplicates
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        projects = {p.get('project') for p in patterns} - {None}
+        rows = []
+        for sub_projects in grouped_slice(list(projects) or [None]):
+            where = table.project == Null
+            if projects:
+                where |= reduce_ids(table.project, sub_projects)
+            cursor.execute(*table.select(
+                    table.id, table.project, table.contacts,
+                    where=where & (table.contacts != Null),
+                    order_by=table.id))
+            rows.extend(cursor)
+        rows = sorted(set(rows))
+        emails = cls.get_emails(r[2] for r in rows)
+
+        result = []
+        for pattern in patterns:
+            if set(pattern) - {'project'}:
+                matches = [r for r, c in zip(rows, cls.browse(
+                            [r[0] for r in rows])) if c.match(pattern)]
+            else:
+                project = pattern.get('project')
+                matches = [r for r in rows
+                    if r[1] is None or r[1] == project]
+            result.append(list(dict.fromkeys(
+                        emails[r[2]] for r in matches if emails[r[2]])))
+        return result
@@ -0,0 +1,280 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Benchmark of the hot paths of project_contact.
+
+It generates synthetic companies, employees, parties, relations, default rules
+and project trees in a database with the module activated (see DB_NAME and
+TRYTOND_DATABASE_URI of trytond.tests.test_tryton), times the operations and
+writes for each one the number of calls, the seconds and the SQL queries as
+JSON. The mails are not sent and the transaction is rolled back.
+
+    python -m trytond.modules.project_contact.tests.benchmark --output bench.json
+
+With --renderer, only the mail renderer is timed over large synthetic inputs
+without database.
+'''
+import argparse
+import datetime
+import json
+import sys
+import time
+from unittest.mock import patch
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.project_contact.renderer import (
+    render_change, render_summary)
+from trytond.modules.project_contact.stats import count_queries
+from trytond.tests.test_tryton import activate_module, with_transaction
+from trytond.pool import Pool
+
+MODULE = 'project_contact'
+
+
+class Benchmark(object):
+
+    def __init__(self):
+        self.results = []
+
+    def measure(self, name, func, *args, calls=1, **kwargs):
+        'Run func and store its timing and query count under name'
+        with count_queries() as queries:
+            result = self.time(name, func, *args, calls=calls, **kwargs)
+        self.results[-1]['queries'] = queries[0]
+        return result
+
+    def time(self, name, func, *args, calls=1, **kwargs):
+        'Run func and store its timing under name'
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self.results.append({
+                'name': name,
+                'calls': calls,
+                'seconds': round(seconds, 6),
+                'seconds_per_call': round(seconds / (calls or 1), 6),
+                })
+        return result
+
+
+def generate(options):
+    '''
+    Create the synthetic data and return the company, the list of works at
+    each depth of the project tree and the list of employees
+    '''
+    pool = Pool()
+    Party = pool.get('party.party')
+    RelationType = pool.get('party.relation.type')
+    Relation = pool.get('party.relation')
+    Employee = pool.get('company.employee')
+    Work = pool.get('project.work')
+    DefaultRule = pool.get('project.work.default_rule')
+
+    company = create_company()
+    employee_parties = Party.create([{
+                'name': 'Employee %s' % i,
+                'contact_mechanisms': [('create', [{
+                                'type': 'email',
+                                'value': 'employee%s@example.com' % i,
+                                }])],
+                } for i in range(options.employees)])
+    employees = Employee.create([{
+                'party': p.id,
+                'company': company.id,
+                } for p in employee_parties])
+    parties = Party.create([{
+                'name': 'Party %s' % i,
+                } for i in range(options.parties)])
+    relation_type, = RelationType.create([{'name': 'Contact'}])
+    Relation.create([{
+                'from_': parties[i].id,
+                'to': parties[(i + j + 1) % len(parties)].id,
+                'type': relation_type.id,
+                }
+            for i in range(len(parties))
+            for j in range(options.relations)])
+
+    levels = []
+    parents = [None]
+    for depth in range(options.depth):
+        levels.append(Work.create([{
+                        'name': 'Project %s.%s' % (depth, i),
+                        'company': company.id,
+                        'party': parties[i % len(parties)].id,
+                        'parent': parent,
+                        }
+                    for i, parent in enumerate(
+                        parents * options.width)]))
+        parents = [w.id for w in levels[-1]]
+
+    projects = [None] + [w.id for level in levels for w in level]
+    DefaultRule.create([{
+                'sequence': i,
+                'project': projects[i % len(projects)],
+                'contacts': [('add', [
+                            employee_parties[i % len(employee_parties)].id,
+                            parties[i % len(parties)].id,
+                            ])],
+                } for i in range(options.rules)])
+    return company, levels, employees
+
+
+@with_transaction()
+def run(options):
+    pool = Pool()
+    Work = pool.get('project.work')
+    WorkParty = pool.get('project.work-party.party')
+    DefaultRule = pool.get('project.work.default_rule')
+    ModelData = pool.get('ir.model.data')
+
+    benchmark = Benchmark()
+    company, levels, employees = generate(options)
+    with set_company(company), \
+            patch('trytond.modules.project_contact.work.'
+                'sendmail_transactional'):
+        leaves = levels[-1]
+        patterns = [{'project': w.id} for w in leaves]
+
+        DefaultRule._rules_cache.clear()
+        benchmark.measure('DefaultRule.compute (cold)',
+            DefaultRule.compute, patterns[0])
+
+        def compute():
+            for pattern in patterns:
+                DefaultRule.compute(pattern)
+        benchmark.measure('DefaultRule.compute', compute,
+            calls=len(patterns))
+
+        def contacts():
+            for leaf in leaves:
+                Work(parent=leaf.id).on_change_with_contacts()
+        benchmark.measure('Work.on_change_with_contacts', contacts,
+            calls=len(leaves))
+
+        def allowed_contacts():
+            for leaf in leaves:
+                WorkParty(work=leaf).on_change_with_allowed_contacts()
+        WorkParty._allowed_contacts_cache.clear()
+        benchmark.measure('WorkParty.on_change_with_allowed_contacts (cold)',
+            allowed_contacts, calls=len(leaves))
+        benchmark.measure('WorkParty.on_change_with_allowed_contacts',
+            allowed_contacts, calls=len(leaves))
+
+        tasks = benchmark.measure('Work.create', Work.create, [{
+                    'name': 'Task %s' % i,
+                    'company': company.id,
+                    'parent': leaves[i % len(leaves)].id,
+                    'contacts': [('create', [{
+                                    'party': employees[
+                                        (i + j) % len(employees)].party.id,
+                                    } for j in range(options.contacts)])],
+                    } for i in range(options.works)],
+            calls=options.works)
+
+        benchmark.measure('Work.write', Work.write, tasks, {
+                'comment': '\n'.join('Line %s' % i for i in range(100)),
+                }, calls=len(tasks))
+        benchmark.measure('Work.write (name)', Work.write, tasks[::2], {
+                'name': 'Renamed',
+                }, calls=len(tasks[::2]))
+        benchmark.measure('Work.write (done)', Work.write, tasks[1::2], {
+                'status': ModelData.get_id('project', 'work_done_status'),
+                'progress': 1,
+                }, calls=len(tasks[1::2]))
+        benchmark.measure('Work.send_summary', Work.send_summary, tasks,
+            calls=len(tasks))
+    return benchmark.results
+
+
+def run_renderer(options):
+    'Time the mail renderer over synthetic data'
+    benchmark = Benchmark()
+    url = 'http://localhost/model/project.work/1'
+    old = ''.join('line %s\n' % i for i in range(options.lines))
+    new = ''.join('line %s\n' % (i if i % 100 else 'changed')
+        for i in range(options.lines))
+    values = {
+        'name': 'Task',
+        'effort_duration': datetime.timedelta(hours=2),
+        'comment': new,
+        'status': 'Open',
+        }
+    fields = [
+        ('name', 'value', None),
+        ('effort_duration', 'value', None),
+        ('comment', 'text', None),
+        ('status', 'value', None),
+        ]
+    rows = [{
+            'description': 'Line %s\nof the work' % i,
+            'date': datetime.datetime(2024, 1, 1, 10, 30),
+            'employee': 'Employee %s' % i,
+            } for i in range(options.rows)]
+    subfields = [
+        ('description', 'text'),
+        ('date', 'datetime'),
+        ('employee', 'value'),
+        ]
+
+    def repeat(func, *args, **kwargs):
+        for _ in range(options.repeat):
+            func(*args, **kwargs)
+    benchmark.time('render_change (created)', repeat, render_change,
+        'Task', url, fields, values, calls=options.repeat)
+    benchmark.time('render_change (comment)', repeat, render_change,
+        'Task', url, [('comment', 'text', None)], values,
+        {'comment': old}, calls=options.repeat)
+    benchmark.time('render_change (one2many)', repeat, render_change,
+        'Task', url, [('lines', 'one2many', subfields)], values,
+        {'lines': []}, {'lines': rows}, max_rows=options.rows,
+        calls=options.repeat)
+    benchmark.time('render_summary', repeat, render_summary,
+        'Task', url, [(f, k) for f, k, _ in fields], values,
+        calls=options.repeat)
+    return benchmark.results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the hot paths of project_contact')
+    parser.add_argument('--employees', type=int, default=200)
+    parser.add_argument('--parties', type=int, default=500)
+    parser.add_argument('--relations', type=int, default=3,
+        help='number of relations per party')
+    parser.add_argument('--rules', type=int, default=2000)
+    parser.add_argument('--depth', type=int, default=8,
+        help='depth of the project trees')
+    parser.add_argument('--width', type=int, default=2,
+        help='number of children per project')
+    parser.add_argument('--works', type=int, default=500,
+        help='number of tasks created')
+    parser.add_argument('--contacts', type=int, default=5,
+        help='number of contacts per task')
+    parser.add_argument('--renderer', action='store_true',
+        help='only benchmark the mail renderer without database')
+    parser.add_argument('--lines', type=int, default=20000,
+        help='number of lines of the rendered comments')
+    parser.add_argument('--rows', type=int, default=5000,
+        help='number of rendered One2Many rows')
+    parser.add_argument('--repeat', type=int, default=10,
+        help='number of renderings')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+        default=sys.stdout)
+    options = parser.parse_args(argv)
+
+    if options.renderer:
+        results = run_renderer(options)
+    else:
+        activate_module(MODULE)
+        results = run(options)
+    json.dump({
+            'module': MODULE,
+            'parameters': {k: v for k, v in vars(options).items()
+                if k != 'output'},
+            'results': results,
+            }, options.output, indent=2)
+    options.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,1265 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from email.mime.text import MIMEText
+from unittest.mock import patch
+
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, create_employee, set_company)
+from trytond.modules.project_contact.exceptions import DomainError
+from trytond.modules.project_contact.renderer import (
+    render_change, render_summary)
+from trytond.modules.project_contact.sendmail import PooledSMTPDataManager
+from trytond.modules.project_contact.stats import get_totals
+from trytond.modules.project_contact.work import (
+    DIFF_MAX_LINES, DIFF_OPTIONS, ONE2MANY_MAX_LINES, _modified_works,
+    get_rec_names, render_text_diff)
+from trytond.config import config
+from trytond.model.exceptions import DomainValidationError
+from trytond.pool import Pool
+from trytond.pyson import PYSONEncoder
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+def create_mail_employee(company, email='pam@example.com'):
+    'Create an employee of the company with an e-mail'
+    Party = Pool().get('party.party')
+    employee = create_employee(company)
+    Party.write([employee.party], {'email': email})
+    return employee
+
+
+def create_mailed_work(company, employee=None, **values):
+    '''
+    Create a work of the company with the values and, unless contacts are
+    given, the employee or a new employee with an e-mail as contact
+    '''
+    Work = Pool().get('project.work')
+    if 'contacts' not in values:
+        if employee is None:
+            employee = create_mail_employee(company)
+        values['contacts'] = [('create', [{'party': employee.party.id}])]
+    work, = Work.create([dict({
+                    'name': 'Work',
+                    'company': company.id,
+                    }, **values)])
+    return work
+
+
+class DummySMTPHandler(socketserver.StreamRequestHandler):
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+    def reply(self, line):
+        self.wfile.write(line + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply(b'220 dummy')
+        for line in self.rfile:
+            command = line.strip().split(b' ', 1)[0].upper()
+            if command in {b'EHLO', b'HELO'}:
+                self.reply(b'250 dummy')
+            elif command == b'DATA':
+                self.reply(b'354 go ahead')
+                data = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                with server.lock:
+                    if server.failures:
+                        server.failures -= 1
+                        self.reply(b'451 try again')
+                        continue
+                    server.messages.append(b''.join(data))
+                self.reply(b'250 ok')
+            elif command == b'QUIT':
+                self.reply(b'221 bye')
+                break
+            else:
+                self.reply(b'250 ok')
+
+
+class DummySMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, failures=0):
+        super().__init__(('127.0.0.1', 0), DummySMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.failures = failures
+        self.messages = []
+
+    @property
+    def uri(self):
+        return 'smtp://%s:%s' % self.server_address
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
 
 
 class ProjectContactTestCase(CompanyTestMixin, ModuleTestCase):
     'Test ProjectContact module'
     module = 'project_contact'
 
+    @with_transaction()
+    def test_default_rule_compute(self):
+        'Test DefaultRule.compute matches the linear scan'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Work = pool.get('project.work')
+        DefaultRule = pool.get('project.work.default_rule')
+
+        company = create_company()
+        with set_company(company):
+            party1, party2, party3 = Party.create([
+                    {'name': 'Party 1'},
+                    {'name': 'Party 2'},
+                    {'name': 'Party 3'},
+                    ])
+            project1, project2 = Work.create([{
+                        'name': 'Project 1',
+                        'company': company.id,
+                        }, {
+                        'name': 'Project 2',
+                        'company': company.id,
+                        }])
+            DefaultRule.create([{
+                        'sequence': 20,
+                        'project': project1.id,
+                        'contacts': [('add', [party2.id, party1.id])],
+                        }, {
+                        'sequence': 10,
+                        'contacts': [('add', [party3.id])],
+                        }, {
+                        'sequence': 30,
+                        'project': project2.id,
+                        'contacts': [('add', [party1.id])],
+                        }])
+
+            def linear_scan(pattern):
+                contacts = []
+                for rule in DefaultRule.search([]):
+                    if rule.match(pattern):
+                        contacts += rule.contacts
+                return list(dict.fromkeys(contacts))
+
+            for pattern in [
+                    {'project': None},
+                    {'project': project1.id},
+                    {'project': project2.id},
+                    ]:
+                self.assertEqual(
+                    DefaultRule.compute(pattern), linear_scan(pattern))
+
+            rule, = DefaultRule.search([('project', '=', project2.id)])
+            DefaultRule.write([rule], {
+                    'contacts': [('add', [party3.id])],
+                    })
+            self.assertEqual(
+                DefaultRule.compute({'project': project2.id}),
+                [party3, party1])
+
+            DefaultRule.delete([rule])
+            self.assertEqual(
+                DefaultRule.compute({'project': project2.id}), [party3])
+
+    @with_transaction()
+    def test_default_rule_precedence(self):
+        'Test the exclude and stop rules of DefaultRule.compute'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Work = pool.get('project.work')
+        DefaultRule = pool.get('project.work.default_rule')
+
+        company = create_company()
+        with set_company(company):
+            party1, party2, party3 = Party.create([
+                    {'name': 'Party 1'},
+                    {'name': 'Party 2'},
+                    {'name': 'Party 3'},
+                    ])
+            project1, project2 = Work.create([{
+                        'name': 'Project %s' % i,
+                        'company': company.id,
+                        } for i in range(1, 3)])
+            DefaultRule.create([{
+                        'sequence': 10,
+                        'contacts': [('add', [party1.id, party2.id])],
+                        }, {
+                        'sequence': 20,
+                        'project': project1.id,
+                        'exclude': True,
+                        'contacts': [('add', [party1.id])],
+                        }, {
+                        'sequence': 30,
+                        'project': project1.id,
+                        'contacts': [('add', [party1.id, party3.id])],
+                        }, {
+                        'sequence': 20,
+                        'project': project2.id,
+                        'stop': True,
+                        'contacts': [('add', [party2.id])],
+                        }, {
+                        'sequence': 30,
+                        'project': project2.id,
+                        'contacts': [('add', [party3.id])],
+                        }])
+
+            self.assertEqual(
+                DefaultRule.compute({'project': None}), [party1, party2])
+            self.assertEqual(
+                DefaultRule.compute({'project': project1.id}),
+                [party2, party3])
+            self.assertEqual(
+                DefaultRule.compute({'project': project2.id}),
+                [party1, party2])
+
+    @with_transaction()
+    def test_default_rule_inheritance(self):
+        'Test DefaultRule.compute inherits the rules of the ancestors'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Work = pool.get('project.work')
+        DefaultRule = pool.get('project.work.default_rule')
+
+        company = create_company()
+        with set_company(company):
+            party1, party2, party3 = Party.create([
+                    {'name': 'Party 1'},
+                    {'name': 'Party 2'},
+                    {'name': 'Party 3'},
+                    ])
+            project, = Work.create([{
+                        'name': 'Project',
+                        'company': company.id,
+                        'children': [('create', [{
+                                        'name': 'Task',
+                                        'company': company.id,
+                                        'children': [('create', [{
+                                                        'name': 'Sub-task',
+                                                        'company': company.id,
+                                                        }])],
+                                        }])],
+                        }])
+            task, = project.children
+            subtask, = task.children
+            DefaultRule.create([{
+                        'sequence': 10,
+                        'project': project.id,
+                        'contacts': [('add', [party1.id])],
+                        }, {
+                        'sequence': 20,
+                        'project': task.id,
+                        'contacts': [('add', [party2.id])],
+                        }, {
+                        'sequence': 30,
+                        'contacts': [('add', [party3.id])],
+                        }])
+
+            self.assertEqual(Work.get_ancestors([subtask.id, project.id]), {
+                    subtask.id: [subtask.id, task.id, project.id],
+                    project.id: [project.id],
+                    })
+            self.assertEqual(
+                DefaultRule.compute({'project': project.id}),
+                [party1, party3])
+            self.assertEqual(
+                DefaultRule.compute({'project': task.id}),
+                [party2, party3, party1])
+            self.assertEqual(
+                DefaultRule.compute({'project': subtask.id}),
+                [party3, party2, party1])
+
+            new_task = Work(parent=subtask)
+            self.assertEqual(new_task.on_change_with_contacts(),
+                [party3.id, party2.id, party1.id])
+
+    @with_transaction()
+    def test_apply_default_rules(self):
+        'Test Work.apply_default_rules'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Work = pool.get('project.work')
+        DefaultRule = pool.get('project.work.default_rule')
+
+        company = create_company()
+        with set_company(company):
+            employee1 = create_employee(company, 'Employee 1')
+            employee2 = create_employee(company, 'Employee 2')
+            party, = Party.create([{'name': 'Party'}])
+            project, = Work.create([{
+                        'name': 'Project',
+                        'company': company.id,
+                        'contacts': [('create', [{
+                                        'party': employee1.party.id,
+                                        }])],
+                        'children': [('create', [{
+                                        'name': 'Task',
+                                        'company': company.id,
+                                        }])],
+                        }])
+            task, = project.children
+            DefaultRule.create([{
+                        'contacts': [('add', [
+                                        employee1.party.id,
+                                        employee2.party.id,
+                                        party.id,
+                                        ])],
+                        }])
+
+            self.assertEqual(Work.apply_default_rules([project]), 1)
+            self.assertEqual(
+                [c.party for c in Work(project.id).contacts],
+                [employee1.party, employee2.party])
+            self.assertEqual(Work(task.id).contacts, ())
+
+            self.assertEqual(
+                Work.apply_default_rules([project], children=True), 2)
+            self.assertEqual(
+                [c.party for c in Work(task.id).contacts],
+                [employee1.party, employee2.party])
+            self.assertEqual(
+                Work.apply_default_rules([project], children=True), 0)
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_get_recipients(self, sendmail_transactional):
+        'Test Work.get_recipients'
+        pool = Pool()
+        Party = pool.get('party.party')
+        RelationType = pool.get('party.relation.type')
+        Relation = pool.get('party.relation')
+        User = pool.get('res.user')
+        Work = pool.get('project.work')
+
+        company = create_company()
+        with set_company(company):
+            employee1 = create_employee(company, 'Employee 1')
+            employee2 = create_employee(company, 'Employee 2')
+            employee3 = create_employee(company, 'Employee 3')
+            Party.write([employee1.party], {'email': 'one@example.com'})
+            Party.write([employee2.party], {'email': 'two@example.com'})
+            customer, = Party.create([{
+                        'name': 'Customer',
+                        'contact_mechanisms': [('create', [{
+                                        'type': 'email',
+                                        'value': 'customer@example.com',
+                                        }])],
+                        }])
+            client, = Party.create([{'name': 'Client'}])
+            relation_type, = RelationType.create([{'name': 'Contact'}])
+            Relation.create([{
+                        'from_': client.id,
+                        'to': customer.id,
+                        'type': relation_type.id,
+                        }])
+            user = User(Transaction().user)
+            User.write([user], {
+                    'employees': [('add', [employee2.id])],
+                    'send_own_changes': False,
+                    })
+            work1, work2 = Work.create([{
+                        'name': 'Work 1',
+                        'company': company.id,
+                        'party': client.id,
+                        'contacts': [('create', [
+                                    {'party': employee1.party.id},
+                                    {'party': employee2.party.id},
+                                    {'party': employee3.party.id},
+                                    {'party': customer.id},
+                                    ])],
+                        }, {
+                        'name': 'Work 2',
+                        'company': company.id,
+                        }])
+
+            self.assertEqual(Work.get_recipients([work1, work2]), {
+                    work1.id: ['one@example.com'],
+                    work2.id: [],
+                    })
+
+            User.write([user], {'send_own_changes': True})
+            self.assertEqual(Work.get_recipients([work1]), {
+                    work1.id: ['one@example.com', 'two@example.com'],
+                    })
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_recipient_policy(self, sendmail_transactional):
+        'Test the recipient policies of Work.get_recipients'
+        pool = Pool()
+        Party = pool.get('party.party')
+        RelationType = pool.get('party.relation.type')
+        Relation = pool.get('party.relation')
+        Work = pool.get('project.work')
+        RecipientPolicy = pool.get('project.work.recipient_policy')
+
+        company = create_company()
+        with set_company(company):
+            employee1 = create_employee(company, 'Employee 1')
+            employee2 = create_employee(company, 'Employee 2')
+            Party.write([employee1.party], {'email': 'one@example.com'})
+            Party.write([employee2.party], {'email': 'two@example.com'})
+            customer, client = Party.create([{
+                        'name': 'Customer',
+                        'email': 'customer@example.com',
+                        }, {
+                        'name': 'Client',
+                        }])
+            relation_type, = RelationType.create([{'name': 'Contact'}])
+            Relation.create([{
+                        'from_': client.id,
+                        'to': customer.id,
+                        'type': relation_type.id,
+                        }])
+            contacts = [('create', [
+                        {'party': employee1.party.id},
+                        {'party': employee2.party.id},
+                        {'party': customer.id},
+                        ])]
+            project, = Work.create([{
+                        'name': 'Project',
+                        'company': company.id,
+                        'party': client.id,
+                        'contacts': contacts,
+                        'children': [('create', [{
+                                        'name': 'Task',
+                                        'company': company.id,
+                                        'party': client.id,
+                                        'contacts': contacts,
+                                        }])],
+                        }])
+            task, = project.children
+            other, = Work.create([{
+                        'name': 'Other',
+                        'company': company.id,
+                        'party': client.id,
+                        'contacts': contacts,
+                        }])
+            employees = ['one@example.com', 'two@example.com']
+
+            self.assertEqual(Work.get_recipients([project, task, other]), {
+                    project.id: employees,
+                    task.id: employees,
+                    other.id: employees,
+                    })
+
+            RecipientPolicy.create([{
+                        'project': project.id,
+                        'contacts': 'all',
+                        }, {
+                        'contacts': 'employees',
+                        'domain': PYSONEncoder().encode(
+                            [('party.name', '=', 'Employee 1')]),
+                        }])
+            self.assertEqual(Work.get_recipients([project, task, other]), {
+                    project.id: ['customer@example.com'] + employees,
+                    task.id: ['customer@example.com'] + employees,
+                    other.id: ['one@example.com'],
+                    })
+
+            for domain in [
+                    "[('party.name', '=', 'Employee 1')]",
+                    PYSONEncoder().encode({'party': 'Employee 1'}),
+                    PYSONEncoder().encode([('unknown', '=', 1)]),
+                    ]:
+                with self.assertRaises(DomainError):
+                    RecipientPolicy.create([{
+                                'contacts': 'all',
+                                'domain': domain,
+                                }])
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_work_recipient(self, sendmail_transactional):
+        'Test the maintenance of the work recipients'
+        pool = Pool()
+        ContactMechanism = pool.get('party.contact_mechanism')
+        Employee = pool.get('company.employee')
+        Work = pool.get('project.work')
+        WorkParty = pool.get('project.work-party.party')
+        WorkRecipient = pool.get('project.work.recipient')
+
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            party = employee.party
+            work, = Work.create([{
+                        'name': 'Work',
+                        'company': company.id,
+                        'contacts': [('create', [{
+                                        'party': party.id,
+                                        }])],
+                        }])
+            contact, = work.contacts
+
+            def recipients():
+                return [(r.party, r.email, r.employee)
+                    for r in WorkRecipient.search([('work', '=', work.id)])]
+
+            self.assertEqual(recipients(), [(party, None, True)])
+            self.assertEqual(Work.get_recipients([work]), {work.id: []})
+
+            mechanism, = ContactMechanism.create([{
+                        'party': party.id,
+                        'type': 'email',
+                        'value': 'pam@example.com',
+                        }])
+            self.assertEqual(recipients(),
+                [(party, 'pam@example.com', True)])
+            self.assertEqual(Work.get_recipients([work]),
+                {work.id: ['pam@example.com']})
+            self.assertTrue(work.employee_contact)
+
+            Employee.delete([employee])
+            self.assertEqual(recipients(),
+                [(party, 'pam@example.com', False)])
+            self.assertEqual(Work.get_recipients([work]), {work.id: []})
+
+            ContactMechanism.delete([mechanism])
+            self.assertEqual(recipients(), [(party, None, False)])
+
+            WorkRecipient.rebuild()
+            self.assertEqual(recipients(), [(party, None, False)])
+
+            WorkParty.delete([contact])
+            self.assertEqual(recipients(), [])
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_create_mail_linear(self, sendmail_transactional):
+        'Test Work.create sends one mail per record in linear time'
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        company = create_company()
+        with set_company(company):
+            employee = create_mail_employee(company)
+
+            def create(size):
+                sendmail_transactional.reset_mock()
+                start = time.perf_counter()
+                Work.create([{
+                            'name': 'Work %s' % i,
+                            'company': company.id,
+                            'contacts': [('create', [{
+                                            'party': employee.party.id,
+                                            }])],
+                            } for i in range(size)])
+                duration = time.perf_counter() - start
+                self.assertEqual(sendmail_transactional.call_count, size)
+                return duration
+
+            create(5)
+            small = create(20)
+            large = create(80)
+            # Quadratic generation would be 16 times slower
+            self.assertLess(large / small, 8)
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.work.QUEUE', True)
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_queue_mails(self, sendmail_transactional):
+        'Test the mails are sent by the queue'
+        pool = Pool()
+        Work = pool.get('project.work')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            work = create_mailed_work(company)
+            Work.write([work], {'comment': 'Comment'})
+            Work.send_summary([work])
+
+            self.assertEqual(sendmail_transactional.call_count, 0)
+            tasks = Queue.search([], order=[('id', 'ASC')])
+            self.assertEqual([t.data['method'] for t in tasks], [
+                    'send_change_mails',
+                    'send_change_mails',
+                    'send_summary_mails',
+                    ])
+
+            for task in tasks:
+                task.run()
+            self.assertEqual(sendmail_transactional.call_count, 3)
+            _, _, msg = sendmail_transactional.call_args_list[1][0]
+            self.assertEqual(str(msg['Subject']), 'Changes in Work')
+            self.assertIn('In-Reply-To', msg)
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.work.SUMMARY_CHUNK', 2)
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_send_summary_batch(self, sendmail_transactional):
+        'Test the summaries are sent by batch'
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Work = pool.get('project.work')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            employee = create_mail_employee(company)
+            works = [create_mailed_work(company, employee, name='Work 0',
+                    contacts=[])] + [
+                create_mailed_work(company, employee, name='Work %s' % i)
+                for i in range(1, 3)]
+            sendmail_transactional.reset_mock()
+
+            self.assertEqual(Work._send_summaries(works), (2, 1))
+            self.assertEqual(
+                [str(c[0][2]['Subject'])
+                    for c in sendmail_transactional.call_args_list],
+                ['Summary of Work 1', 'Summary of Work 2'])
+
+            sendmail_transactional.reset_mock()
+            done_id = ModelData.get_id('project', 'work_done_status')
+            Work.write([works[1], works[1]], {
+                    'status': done_id,
+                    'progress': 1,
+                    }, [works[1]], {
+                    'status': done_id,
+                    })
+            self.assertEqual(
+                [str(c[0][2]['Subject'])
+                    for c in sendmail_transactional.call_args_list
+                    if str(c[0][2]['Subject']).startswith('Summary')],
+                ['Summary of Work 1'])
+
+            with patch('trytond.modules.project_contact.work.QUEUE', True):
+                Work.send_summary(works)
+            tasks = Queue.search([], order=[('id', 'ASC')])
+            self.assertEqual([t.data['method'] for t in tasks],
+                ['send_summary_mails', 'send_summary_mails'])
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.work.DEDUPE', 60)
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_mail_threading(self, sendmail_transactional):
+        'Test the mails of a work are threaded and deduplicated'
+        pool = Pool()
+        Work = pool.get('project.work')
+        MailLog = pool.get('project.work.mail_log')
+
+        company = create_company()
+        with set_company(company):
+            work = create_mailed_work(company)
+            Work.write([work], {'comment': 'Comment'})
+            Work.send_summary([work])
+            Work.send_summary([work])
+
+            self.assertEqual(sendmail_transactional.call_count, 3)
+            (_, _, created), (_, _, changed), (_, _, summary) = [
+                c[0] for c in sendmail_transactional.call_args_list]
+            root = created['Message-ID']
+            self.assertNotIn('In-Reply-To', created)
+            self.assertEqual(changed['In-Reply-To'], root)
+            self.assertEqual(changed['References'], root)
+            self.assertEqual(summary['In-Reply-To'], changed['Message-ID'])
+            self.assertEqual(summary['References'],
+                '%s %s' % (root, changed['Message-ID']))
+            self.assertEqual(len({m['Message-ID']
+                        for m in [created, changed, summary]}), 3)
+
+            logs = MailLog.search([], order=[('id', 'ASC')])
+            self.assertEqual([l.message_id for l in logs],
+                [m['Message-ID'] for m in [created, changed, summary]])
+            self.assertEqual({l.recipients for l in logs},
+                {'pam@example.com'})
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.work.COALESCE', 60)
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_coalesce_mails(self, sendmail_transactional):
+        'Test the changes of a work are coalesced in one mail'
+        pool = Pool()
+        Work = pool.get('project.work')
+        MailChange = pool.get('project.work.mail_change')
+        cursor = Transaction().connection.cursor()
+        table = MailChange.__table__()
+
+        company = create_company()
+        with set_company(company):
+            work = create_mailed_work(company)
+            sendmail_transactional.reset_mock()
+
+            Work.write([work], {'comment': 'First'})
+            Work.write([work], {'comment': 'Second'})
+            Work.write([work], {'name': 'Renamed'})
+            self.assertEqual(sendmail_transactional.call_count, 0)
+            change, = MailChange.search([])
+            self.assertEqual(change.old_values['comment'], None)
+            self.assertEqual(change.old_values['name'], 'Work')
+
+            MailChange.send_pending()
+            self.assertEqual(sendmail_transactional.call_count, 0)
+
+            cursor.execute(*table.update([table.create_date],
+                    [datetime.datetime.now() - datetime.timedelta(hours=1)]))
+            MailChange.send_pending()
+            self.assertEqual(sendmail_transactional.call_count, 1)
+            _, _, msg = sendmail_transactional.call_args[0]
+            body = msg.get_payload(decode=True).decode('utf-8')
+            self.assertIn('Second', body)
+            self.assertNotIn('First', body)
+            self.assertIn('- Work', body)
+            self.assertFalse(MailChange.search([]))
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.work.DIGEST', True)
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_digest_mails(self, sendmail_transactional):
+        'Test the digest sends one mail per recipient'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Work = pool.get('project.work')
+        MailChange = pool.get('project.work.mail_change')
+
+        company = create_company()
+        with set_company(company):
+            employee1 = create_employee(company, 'Employee 1')
+            employee2 = create_employee(company, 'Employee 2')
+            Party.write([employee1.party], {'email': 'one@example.com'})
+            Party.write([employee2.party], {'email': 'two@example.com'})
+            work1, work2 = Work.create([{
+                        'name': 'Work 1',
+                        'company': company.id,
+                        'contacts': [('create', [
+                                    {'party': employee1.party.id},
+                                    {'party': employee2.party.id},
+                                    ])],
+                        }, {
+                        'name': 'Work 2',
+                        'company': company.id,
+                        'contacts': [('create', [
+                                    {'party': employee1.party.id},
+                                    ])],
+                        }])
+            sendmail_transactional.reset_mock()
+
+            Work.write([work1, work2], {'comment': 'Comment'})
+            MailChange.send_digest()
+
+            self.assertEqual(sendmail_transactional.call_count, 2)
+            messages = {c[0][1][0]: c[0][2]
+                for c in sendmail_transactional.call_args_list}
+            self.assertEqual(
+                str(messages['one@example.com']['Subject']),
+                'Changes in 2 works')
+            self.assertEqual(
+                str(messages['two@example.com']['Subject']),
+                'Changes in 1 works')
+            self.assertFalse(MailChange.search([]))
+
+    @with_transaction()
+    def test_mail_renderers(self):
+        'Test the mail renderers are computed once per model'
+        pool = Pool()
+        Work = pool.get('project.work')
+        Status = pool.get('project.work.status')
+
+        renderers = Work.get_mail_renderers()
+        self.assertEqual([r[0] for r in renderers],
+            list(Work.get_mail_fields()))
+        self.assertIs(Work.get_mail_renderers(), renderers)
+        self.assertEqual([r[1] for r in renderers],
+            ['value', 'value', 'text', 'value'])
+        _, _, _, convert = renderers[3]
+        status, = Status.search([], limit=1)
+        self.assertEqual(convert(status.id), status.rec_name)
+
+    @with_transaction()
+    def test_summary_body_renderer(self):
+        'Test the summary of a work is the one of the renderer'
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        company = create_company()
+        with set_company(company):
+            work, = Work.create([{
+                        'name': 'Work',
+                        'company': company.id,
+                        'comment': 'First\nSecond <line>',
+                        }])
+            uid = work.write_uid or work.create_uid
+            self.assertEqual(work.get_summary_body(), render_summary(
+                    'Work', '%s/model/project.work/%s' % (
+                        config.get('project_contact', 'url'), work.id), [
+                        ('name', 'value'),
+                        ('effort_duration', 'value'),
+                        ('comment', 'text'),
+                        ('status', 'value'),
+                        ], {
+                        'name': 'Work',
+                        'effort_duration': work.effort_duration,
+                        'comment': work.comment,
+                        'status': work.status.rec_name,
+                        }, user=uid.name, date=work.get_mail_date()))
+
+    @with_transaction()
+    def test_change_body_renderer(self):
+        'Test the changes of a work are the ones of the renderer'
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        company = create_company()
+        with set_company(company):
+            work, = Work.create([{
+                        'name': 'Work',
+                        'company': company.id,
+                        'comment': 'First\nSecond <line>',
+                        }])
+            url = '%s/model/project.work/%s' % (
+                config.get('project_contact', 'url'), work.id)
+            uid = work.write_uid or work.create_uid
+            values = {
+                'name': 'Work',
+                'effort_duration': work.effort_duration,
+                'comment': work.comment,
+                'status': work.status.rec_name,
+                }
+            options = dict(user=uid.name, date=work.get_mail_date(),
+                max_rows=ONE2MANY_MAX_LINES, **DIFF_OPTIONS)
+
+            # The empty fields are not rendered
+            self.assertEqual(work.get_mail_body(), render_change(
+                    'Work', url, [
+                        ('name', 'value', None),
+                        ('comment', 'text', None),
+                        ('status', 'value', None),
+                        ], values, **options))
+            self.assertEqual(work.get_mail_body(None, {
+                        'name': 'Old',
+                        'comment': 'First\n',
+                        'status': work.status.id,
+                        }), render_change('Work', url, [
+                        ('name', 'value', None),
+                        ('comment', 'text', None),
+                        ], values, {
+                        'name': 'Old',
+                        'comment': 'First\n',
+                        }, **options))
+
+    def test_render_text_diff(self):
+        'Test render_text_diff'
+        old = ''.join('line %s\n' % i for i in range(1000))
+        new = old.replace('line 10\n', 'line ten\n').replace(
+            'line 900\n', 'line nine hundred\n')
+
+        self.assertEqual(render_text_diff(old, new), [
+                ' line 7', ' line 8', ' line 9',
+                '<font color="red">-line 10</font>',
+                '<font color="green">+line ten</font>',
+                ' line 11', ' line 12', ' line 13',
+                ' line 897', ' line 898', ' line 899',
+                '<font color="red">-line 900</font>',
+                '<font color="green">+line nine hundred</font>',
+                ' line 901', ' line 902', ' line 903',
+                ])
+
+    def test_render_text_diff_bounded(self):
+        'Test render_text_diff of large texts is bounded'
+        old = ''.join('line %s\n' % i for i in range(100000))
+        new = ''.join('line %s\n' % (i * 2) for i in range(100000))
+
+        start = time.perf_counter()
+        body = render_text_diff(old, new)
+        self.assertLess(time.perf_counter() - start, 10)
+        self.assertEqual(len(body), DIFF_MAX_LINES + 1)
+        self.assertEqual(body[-1],
+            '<i>%s more lines changed</i>' % (100000 - DIFF_MAX_LINES))
+
+    @with_transaction()
+    def test_get_rec_names(self):
+        'Test get_rec_names reads once and is cleared by modifications'
+        pool = Pool()
+        Party = pool.get('party.party')
+
+        party1, party2 = Party.create([
+                {'name': 'Party 1'},
+                {'name': 'Party 2'},
+                ])
+        with patch.object(Party, 'read', wraps=Party.read) as read:
+            self.assertEqual(get_rec_names(Party, [party1.id, None]), {
+                    party1.id: 'Party 1',
+                    })
+            self.assertEqual(
+                get_rec_names(Party, [party1.id, party2.id]), {
+                    party1.id: 'Party 1',
+                    party2.id: 'Party 2',
+                    })
+            self.assertEqual(read.call_count, 2)
+            self.assertEqual(read.call_args[0][0], [party2.id])
+
+            get_rec_names(Party, [party1.id, party2.id])
+            self.assertEqual(read.call_count, 2)
+
+            Party.write([party1], {'name': 'Renamed'})
+            self.assertEqual(get_rec_names(Party, [party1.id]), {
+                    party1.id: 'Renamed',
+                    })
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_write_old_values(self, sendmail_transactional):
+        'Test Work.write reads only the changed mail fields of mailed works'
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        company = create_company()
+        with set_company(company):
+            work1 = create_mailed_work(company, name='Work 1')
+            work2 = create_mailed_work(company, name='Work 2', contacts=[])
+            sendmail_transactional.reset_mock()
+
+            def mail_reads(read):
+                return [c[0] for c in read.call_args_list
+                    if set(c[0][1]) <= set(Work.get_mail_fields())]
+
+            with patch.object(Work, 'read', wraps=Work.read) as read:
+                Work.write([work1, work2], {'progress': 0.5})
+                self.assertEqual(mail_reads(read), [])
+
+                Work.write([work1, work2], {'name': 'Renamed'})
+                self.assertEqual(mail_reads(read), [([work1.id], ['name'])])
+
+            self.assertEqual(sendmail_transactional.call_count, 1)
+            _, _, msg = sendmail_transactional.call_args[0]
+            body = msg.get_payload(decode=True).decode('utf-8')
+            self.assertIn('- Work 1', body)
+            self.assertNotIn('Status', body)
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.work.ONE2MANY_MAX_LINES', 3)
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_one2many_changes(self, sendmail_transactional):
+        'Test the mails of the One2Many changes'
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        company = create_company()
+        with set_company(company), patch.object(Work, 'get_mail_fields',
+                return_value=OrderedDict([('children', ['name'])])):
+            employee = create_mail_employee(company)
+            work, other = [create_mailed_work(company, employee, name=name,
+                    children=[('create', [{
+                                    'name': 'Child',
+                                    'company': company.id,
+                                    }])])
+                for name in ['Work', 'Other']]
+            child, = work.children
+            other_child, = other.children
+
+            def body(work=work):
+                for _, _, msg in (c[0] for c in reversed(
+                            sendmail_transactional.call_args_list)):
+                    if str(msg['Subject']).endswith(work.rec_name):
+                        return msg.get_payload(decode=True).decode('utf-8')
+
+            Work.write([work], {
+                    'children': [
+                        ('write', [child.id], {'name': 'Renamed'}),
+                        ('create', [{
+                                    'name': 'New',
+                                    'company': company.id,
+                                    }]),
+                        ],
+                    })
+            self.assertIn('<b>Updated</b>: Work\\Child', body())
+            self.assertIn('<b>Name</b>: Renamed', body())
+            self.assertIn('<b>Name</b>: New', body())
+            self.assertNotIn('more lines changed', body())
+
+            Work.write([work], {
+                    'children': [
+                        ('delete', [child.id]),
+                        ('create', [{
+                                    'name': 'Line %s' % i,
+                                    'company': company.id,
+                                    } for i in range(5)]),
+                        ],
+                    })
+            self.assertIn('- Work\\Renamed', body())
+            self.assertIn('<b>Name</b>: Line 1', body())
+            self.assertNotIn('<b>Name</b>: Line 2', body())
+            self.assertIn('3 more lines changed', body())
+
+            sendmail_transactional.reset_mock()
+            Work.write([work], {
+                    'children': [('create', [{
+                                    'name': 'Extra',
+                                    'company': company.id,
+                                    }])],
+                    }, [other], {
+                    'children': [('delete', [other_child.id])],
+                    })
+            self.assertIn('<b>Name</b>: Extra', body())
+            self.assertNotIn('Other\\Child', body())
+            self.assertIn('- Other\\Child', body(other))
+            self.assertNotIn('Extra', body(other))
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.stats.STATS', True)
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_stats(self, sendmail_transactional):
+        'Test the stats of the mail operations'
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        company = create_company()
+        with set_company(company):
+            work = create_mailed_work(company)
+            before = get_totals()
+            Work.write([work], {'name': 'Renamed'})
+            after = get_totals()
+
+            def delta(key):
+                return after.get(key, 0) - before.get(key, 0)
+            self.assertEqual(delta('write.count'), 1)
+            self.assertEqual(delta('write.messages'), 1)
+            self.assertEqual(delta('write.recipients.count'), 2)
+            self.assertEqual(delta('write.snapshot.count'), 1)
+            self.assertEqual(delta('write.handoff.count'), 1)
+            self.assertGreater(delta('write.bytes'), 0)
+            self.assertGreater(delta('write.queries'), 0)
+            # Nested operations are accounted in the outermost one
+            self.assertEqual(delta('send_change_mails.count'), 0)
+
+    @with_transaction()
+    @patch('trytond.modules.project_contact.work.sendmail_transactional')
+    def test_summary_mail_cache(self, sendmail_transactional):
+        'Test the summaries are rendered once until the work is modified'
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        company = create_company()
+        with set_company(company):
+            work = create_mailed_work(company, comment='Comment')
+            sendmail_transactional.reset_mock()
+            # The works created or written by the transaction are not cached
+            self.assertIsNone(work.get_summary_key())
+            _modified_works.pop(Transaction())
+            work = Work(work.id)
+
+            with patch.object(Work, 'get_summary_body', autospec=True,
+                    side_effect=Work.get_summary_body) as get_summary_body:
+                Work.send_summary([work])
+                Work.send_summary([work])
+                self.assertEqual(get_summary_body.call_count, 1)
+
+                Work.write([work], {'comment': 'New comment'})
+                sendmail_transactional.reset_mock()
+                Work.send_summary([Work(work.id)])
+                self.assertEqual(get_summary_body.call_count, 2)
+                Work.send_summary([Work(work.id)])
+                self.assertEqual(get_summary_body.call_count, 3)
+
+            _, _, msg = sendmail_transactional.call_args[0]
+            body = msg.get_payload(decode=True).decode('utf-8')
+            self.assertIn('New comment', body)
+            self.assertIs(
+                Work.get_mail_timezone(), Work.get_mail_timezone())
+
+    @with_transaction()
+    def test_summary_contacts_compute(self):
+        'Test SummaryContacts.compute_patterns'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Work = pool.get('project.work')
+        SummaryContacts = pool.get('project.work.summary_contacts')
+
+        company = create_company()
+        with set_company(company):
+            party1, party2, party3 = Party.create([{
+                        'name': 'Party %s' % i,
+                        'contact_mechanisms': [('create', [{
+                                        'type': 'email',
+                                        'value': 'party%s@example.com' % i,
+                                        }])],
+                        } for i in range(1, 4)])
+            project1, project2 = Work.create([{
+                        'name': 'Project %s' % i,
+                        'company': company.id,
+                        } for i in range(1, 3)])
+            SummaryContacts.create([{
+                        'project': project1.id,
+                        'contacts': party2.id,
+                        }, {
+                        'contacts': party1.id,
+                        }, {
+                        'project': project1.id,
+                        'contacts': party1.id,
+                        }, {
+                        'project': project2.id,
+                        'contacts': party3.id,
+                        }])
+
+            self.assertEqual(SummaryContacts.compute_patterns([
+                        {'project': project1.id},
+                        {'project': None},
+                        {'project': project2.id},
+                        ]), [
+                    ['party2@example.com', 'party1@example.com'],
+                    ['party1@example.com'],
+                    ['party1@example.com', 'party3@example.com'],
+                    ])
+            self.assertEqual(
+                SummaryContacts.compute({'project': project2.id}),
+                ['party1@example.com', 'party3@example.com'])
+            self.assertEqual(SummaryContacts.get_mail(), [
+                    'party2@example.com', 'party1@example.com',
+                    'party3@example.com'])
+
+    @with_transaction()
+    def test_allowed_contacts(self):
+        'Test the allowed contacts of the work contacts'
+        pool = Pool()
+        Party = pool.get('party.party')
+        RelationType = pool.get('party.relation.type')
+        Relation = pool.get('party.relation')
+        Work = pool.get('project.work')
+        WorkParty = pool.get('project.work-party.party')
+
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            client, customer, other = Party.create([
+                    {'name': 'Client'},
+                    {'name': 'Customer'},
+                    {'name': 'Other'},
+                    ])
+            relation_type, = RelationType.create([{'name': 'Contact'}])
+            Relation.create([{
+                        'from_': client.id,
+                        'to': customer.id,
+                        'type': relation_type.id,
+                        }])
+            work, = Work.create([{
+                        'name': 'Work',
+                        'company': company.id,
+                        'party': client.id,
+                        }])
+
+            self.assertEqual(
+                sorted(WorkParty.get_allowed_contacts(company.id, client.id)),
+                sorted([employee.party.id, customer.id]))
+            WorkParty.create([
+                    {'work': work.id, 'party': employee.party.id},
+                    {'work': work.id, 'party': customer.id},
+                    ])
+            with self.assertRaises(DomainValidationError):
+                WorkParty.create([{'work': work.id, 'party': other.id}])
+
+            new_employee = create_employee(company, 'New Employee')
+            self.assertIn(new_employee.party.id,
+                WorkParty.get_allowed_contacts(company.id, client.id))
+
+    @with_transaction()
+    def test_search_contacts(self):
+        'Test searching work contacts by company and works by contacts'
+        pool = Pool()
+        Work = pool.get('project.work')
+        WorkParty = pool.get('project.work-party.party')
+
+        company = create_company()
+        other_company = create_company('Other')
+        with set_company(company):
+            employee = create_employee(company)
+            work1, work2 = Work.create([{
+                        'name': 'Work 1',
+                        'company': company.id,
+                        'contacts': [('create', [{
+                                        'party': employee.party.id,
+                                        }])],
+                        }, {
+                        'name': 'Work 2',
+                        'company': company.id,
+                        }])
+            contact, = work1.contacts
+
+            self.assertEqual(
+                WorkParty.search([('company', '=', company.id)]), [contact])
+            self.assertEqual(
+                WorkParty.search([('company', '=', other_company.id)]), [])
+            self.assertEqual(
+                WorkParty.search([('company.party.name', '=', 'Other')]),
+                [])
+            self.assertEqual(WorkParty.search([
+                        ('company', 'in', [company.id, other_company.id]),
+                        ]), [contact])
+            self.assertEqual(WorkParty.search([
+                        ('company', 'ilike', '%%%s%%' % company.rec_name),
+                        ]), [contact])
+            self.assertEqual(WorkParty.search([
+                        ('company', '=', company.rec_name),
+                        ]), [contact])
+            self.assertEqual(WorkParty.read([contact.id], ['company']), [{
+                        'id': contact.id,
+                        'company': company.id,
+                        }])
+
+            self.assertEqual(Work.search([
+                        ('contacts.party', '=', employee.party.id),
+                        ]), [work1])
+            self.assertEqual(Work.search([
+                        ('employee_contact', '=', True),
+                        ]), [work1])
+            self.assertEqual(Work.search([
+                        ('employee_contact', '=', False),
+                        ]), [work2])
+            self.assertEqual([w.employee_contact for w in [work1, work2]],
+                [True, False])
+            for operator, value, result in [
+                    ('!=', True, [work2]),
+                    ('in', [False], [work2]),
+                    ('in', [True, False], [work1, work2]),
+                    ('in', [], []),
+                    ('not in', [False], [work1]),
+                    ('not in', [True, False], []),
+                    ]:
+                self.assertEqual(Work.search([
+                            ('employee_contact', operator, value),
+                            ], order=[('id', 'ASC')]), result)
+            with self.assertRaises(NotImplementedError):
+                Work.search([('employee_contact', '>', False)])
+
+    def test_pooled_smtp_delivery(self):
+        'Test the mails of a transaction are delivered over pooled connections'
+        def deliver(server, concurrency, size):
+            datamanager = PooledSMTPDataManager(server.uri,
+                concurrency=concurrency, retry=2, backoff=0)
+            for i in range(size):
+                msg = MIMEText('Message %s' % i)
+                msg['Subject'] = 'Message %s' % i
+                datamanager.put('from@example.com', ['to@example.com'], msg)
+            datamanager.tpc_vote(None)
+            datamanager.tpc_finish(None)
+
+        with DummySMTPServer() as server:
+            deliver(server, 1, 5)
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(len(server.messages), 5)
+
+        with DummySMTPServer() as server:
+            deliver(server, 3, 7)
+            self.assertEqual(server.connections, 3)
+            self.assertEqual(len(server.messages), 7)
+
+        with DummySMTPServer(failures=2) as server:
+            deliver(server, 1, 3)
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(len(server.messages), 3)
+
 
 del ModuleTestCase
@@ -0,0 +1,122 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import datetime
+import os
+import unittest
+
+from trytond.modules.project_contact.renderer import (
+    render_change, render_summary, render_text_diff)
+
+GOLDEN = os.path.join(os.path.dirname(__file__), 'golden')
+URL = 'http://localhost:8000/demo/model/project.work/1'
+FIELDS = [
+    ('name', 'value', None),
+    ('effort_duration', 'value', None),
+    ('comment', 'text', None),
+    ('status', 'value', None),
+    ]
+VALUES = {
+    'name': 'Task <1>',
+    'effort_duration': datetime.timedelta(hours=2),
+    'comment': 'First line\nSecond & line\n',
+    'status': 'Open',
+    }
+
+
+def lines(size, changed=()):
+    return ''.join('line %s\n' % (i if i not in changed else 'changed')
+        for i in range(size))
+
+
+class RendererTestCase(unittest.TestCase):
+    'Test the mail renderer'
+
+    def assertGolden(self, name, html):
+        path = os.path.join(GOLDEN, name + '.html')
+        if os.environ.get('GOLDEN_UPDATE'):
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(html)
+        with open(path, encoding='utf-8') as file:
+            self.assertEqual(html, file.read())
+
+    def test_created(self):
+        'Test the mail of a created work'
+        self.assertGolden('created', render_change('Task <1>', URL, FIELDS,
+                VALUES, user='Admin', date='2024-01-02 10:30'))
+
+    def test_updated(self):
+        'Test the mail of an updated work'
+        self.assertGolden('updated', render_change('Task <1>', URL, [
+                    ('name', 'value', None),
+                    ('comment', 'text', None),
+                    ], VALUES, {
+                    'name': 'Task',
+                    'comment': 'First line\nSecond line\n',
+                    }, user='Admin', date='2024-01-02 10:30'))
+
+    def test_one2many(self):
+        'Test the mail of the One2Many changes'
+        rows = [{
+                'description': 'New line',
+                'date': datetime.datetime(2024, 1, 2, 10, 30),
+                'employee': 'Pam',
+                }, {
+                '_action': 'write',
+                '_rec_name': 'Old line',
+                'id': 1,
+                'description': 'Changed',
+                }, {
+                '_action': 'delete',
+                '_rec_name': 'Deleted line',
+                'id': 2,
+                }, {
+                '_action': 'add',
+                '_rec_name': 'Added line',
+                'id': 3,
+                }, {
+                '_action': 'remove',
+                '_rec_name': 'Hidden line',
+                'id': 4,
+                }, {
+                '_omitted': 5,
+                }]
+        self.assertGolden('one2many', render_change('Task', URL, [
+                    ('lines', 'one2many', [
+                            ('description', 'text'),
+                            ('date', 'datetime'),
+                            ('employee', 'value'),
+                            ]),
+                    ], VALUES, {'lines': []}, {'lines': rows},
+                user='Admin', date='2024-01-02 10:30', max_rows=4))
+
+    def test_large_comment(self):
+        'Test the mail of the change of a large comment'
+        old = lines(5000)
+        new = lines(5000, changed={10, 2500, 4990})
+        self.assertGolden('large_comment', render_change('Task', URL, [
+                    ('comment', 'text', None),
+                    ], {'comment': new}, {'comment': old},
+                user='Admin', date='2024-01-02 10:30', max_lines=500,
+                max_hunks=2))
+
+    def test_diff_timeout(self):
+        'Test the alignment of the diff stops after the timeout'
+        old = lines(5000)
+        new = lines(5000, changed=set(range(0, 5000, 7)))
+        self.assertEqual(
+            render_text_diff(old, new, timeout=0),
+            render_text_diff(old, new, timeout=0, match_lines=0))
+
+        old = lines(1000)
+        new = lines(1000, changed={10, 500})
+        self.assertIn(' line 9', render_text_diff(old, new))
+        self.assertNotIn(' line 9', render_text_diff(old, new, timeout=0))
+
+    def test_summary(self):
+        'Test the summary mail'
+        self.assertGolden('summary', render_summary('Task <1>', URL, [
+                    ('name', 'value'),
+                    ('effort_duration', 'value'),
+                    ('comment', 'text'),
+                    ('status', 'value'),
+                    ], VALUES, user='Admin', date='2024-01-02 10:30'))
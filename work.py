@@ -1,25 +1,141 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-import difflib
-import html
+import datetime
+import hashlib
+import logging
 import pytz
+import uuid
 
 from urllib.parse import urlparse
 from email.mime.text import MIMEText
 from email.header import Header
-from collections import OrderedDict
-
-from trytond.model import ModelSQL, ModelView, fields, sequence_ordered
+from collections import OrderedDict, defaultdict
+from weakref import WeakKeyDictionary
+from sql import Literal, Null
+from sql.aggregate import Max
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp
+from sql.operators import Exists
+
+from trytond import backend
+from trytond.cache import Cache, LRUDictTransaction
+from trytond.model import (Model, ModelSQL, ModelView, Index, fields,
+    sequence_ordered)
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
-from trytond.sendmail import sendmail_transactional
 from trytond.config import config
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+
+from .renderer import (HTML, render_change, render_summary,
+    render_text_diff as _render_text_diff)
+from .sendmail import sendmail_transactional
+from .stats import operation, stage, incr
 
-__all__ = ['WorkParty', 'Work']
+__all__ = ['WorkParty', 'Work', 'WorkRecipient', 'WorkMailChange',
+    'WorkMailLog',
+    'ApplyDefaultRulesStart', 'ApplyDefaultRules']
+
+logger = logging.getLogger(__name__)
 
 FROM_ADDR = config.get('email', 'from')
 URL = config.get('project_contact', 'url')
+NETLOC = urlparse(URL or '').netloc
+QUEUE = config.getboolean('project_contact', 'queue', default=False)
+COALESCE = config.getint('project_contact', 'coalesce', default=0)
+DIGEST = config.getboolean('project_contact', 'digest', default=False)
+# Seconds during which an identical mail to the same recipients is skipped
+DEDUPE = config.getint('project_contact', 'dedupe', default=0)
+# Maximum number of previous Message-IDs kept in References after the root
+REFERENCES_MAX = 10
+DIFF_MAX_LINES = config.getint('project_contact', 'diff_max_lines',
+    default=500)
+DIFF_MAX_HUNKS = config.getint('project_contact', 'diff_max_hunks',
+    default=20)
+DIFF_TIMEOUT = config.getfloat('project_contact', 'diff_timeout', default=1)
+APPLY_RULES_CHUNK = config.getint('project_contact', 'apply_rules_chunk',
+    default=1000)
+# Number of works per task when the summaries are sent by the queue
+SUMMARY_CHUNK = config.getint('project_contact', 'summary_chunk',
+    default=100)
+# Above this number of lines, the texts are compared without alignment
+DIFF_MATCH_LINES = 20000
+DIFF_OPTIONS = {
+    'max_lines': DIFF_MAX_LINES,
+    'max_hunks': DIFF_MAX_HUNKS,
+    'timeout': DIFF_TIMEOUT,
+    'match_lines': DIFF_MATCH_LINES,
+    }
+ONE2MANY_MAX_LINES = config.getint('project_contact', 'one2many_max_lines',
+    default=100)
+
+_rec_names = WeakKeyDictionary()
+_timezones = WeakKeyDictionary()
+_modified_works = WeakKeyDictionary()
+
+
+def get_rec_names(Model, ids):
+    '''
+    Return a dictionary with the id as key and the rec_name as value for the
+    ids of Model.
+    The missing rec_names are read in one call and kept for the transaction
+    until a record is modified.
+    '''
+    transaction = Transaction()
+    cache = _rec_names.get(transaction)
+    if cache is None:
+        cache = _rec_names[transaction] = LRUDictTransaction(
+            config.getint('cache', 'record'))
+    cache.refresh()
+    key = (Model.__name__, transaction.user, transaction.language)
+    rec_names = {}
+    missing = []
+    for id_ in ids:
+        if id_ is None:
+            continue
+        try:
+            rec_names[id_] = cache[key + (id_,)]
+        except KeyError:
+            missing.append(id_)
+    if missing:
+        for values in Model.read(missing, ['rec_name']):
+            rec_names[values['id']] = cache[key + (values['id'],)] = (
+                values['rec_name'])
+    return rec_names
+
+
+def mail_getter(field):
+    'Return the function that converts the values of field for the mail'
+    if isinstance(field, fields.Many2One):
+        def get_value(value):
+            if value:
+                Model = Pool().get(field.model_name)
+                value = mail_value(value)
+                return get_rec_names(Model, [value])[value]
+            return value
+    else:
+        def get_value(value):
+            return value
+    return get_value
+
+
+def render_text_diff(old, new):
+    '''
+    Return the HTML lines of the diff between the old and new text bounded by
+    the diff options of the configuration
+    '''
+    return _render_text_diff(old, new, **DIFF_OPTIONS)
+
+
+def mail_value(value):
+    'Return the value with the records replaced by their id'
+    if isinstance(value, Model):
+        return value.id
+    elif isinstance(value, (list, tuple)):
+        return [mail_value(v) for v in value]
+    return value
+
 
 class WorkParty(sequence_ordered(), ModelView, ModelSQL):
     'Work Party'
@@ -28,11 +144,14 @@ class WorkParty(sequence_ordered(), ModelView, ModelSQL):
     work = fields.Many2One('project.work', 'Work',
         required=True, ondelete='CASCADE')
     party = fields.Many2One('party.party', 'Party',
-            domain=[('id', 'in', Eval('allowed_contacts', [])),],
+        domain=['OR',
+            ('employees.company', '=', Eval('company', -1)),
+            ('reverse_relations.from_', '=', Eval('work_party', -1)),
+            ],
         context={
                 'company': Eval('company', -1),
             },
-        depends=['allowed_contacts', 'company'],
+        depends=['company', 'work_party'],
         required=True)
     allowed_contacts = fields.Function(fields.Many2Many('party.party',
             None, None, 'Allowed Contacts',
@@ -43,41 +162,159 @@ class WorkParty(sequence_ordered(), ModelView, ModelSQL):
         'on_change_with_allowed_contacts')
     company = fields.Function(fields.Many2One('company.company', "Company"),
                               'get_company', searcher='search_company')
+    work_party = fields.Function(fields.Many2One('party.party', "Work Party",
+            context={
+                'company': Eval('company', -1),
+            },
+            depends=['company']),
+        'on_change_with_work_party')
+    _allowed_contacts_cache = Cache(
+        'project.work-party.party.allowed_contacts', context=False)
 
-
-    @fields.depends('_parent_work.id', '_parent_work.party', 'work', 'company',
-                    'party')
+    @fields.depends('work', '_parent_work.company', '_parent_work.party')
     def on_change_with_allowed_contacts(self, name=None):
+        if self.work:
+            return self.get_allowed_contacts(self.work.company.id,
+                self.work.party.id if self.work.party else None)
+        return []
+
+    @classmethod
+    def get_allowed_contacts(cls, company, party=None):
+        '''
+        Return the ids of the employees of the company and of the parties
+        related to the party
+        '''
         pool = Pool()
         Employee = pool.get('company.employee')
-        res = []
-        if self.work:
-            res = [e.party.id for e in Employee.search(
-                ['company', '=', self.work.company.id])]
-            if self.work.party:
-                res.extend(r.to.id for r in self.work.party.relations)
-        return res
+        Party = pool.get('party.party')
+        key = (company, party)
+        contacts = cls._allowed_contacts_cache.get(key)
+        if contacts is None:
+            contacts = [e.party.id for e in Employee.search(
+                    ['company', '=', company])]
+            if party:
+                contacts.extend(r.to.id for r in Party(party).relations)
+            cls._allowed_contacts_cache.set(key, contacts)
+        return list(contacts)
 
-    def get_company(self, name):
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        WorkRecipient = pool.get('project.work.recipient')
+        super().on_modification(mode, records, field_names=field_names)
+        if mode in {'create', 'write'}:
+            WorkRecipient.update_work_parties([r.id for r in records])
+
+    @fields.depends('work', '_parent_work.company')
+    def on_change_with_company(self, name=None):
         return self.work.company if self.work else None
 
+    @fields.depends('work', '_parent_work.party')
+    def on_change_with_work_party(self, name=None):
+        return self.work.party if self.work else None
+
+    @classmethod
+    def get_company(cls, contacts, name):
+        pool = Pool()
+        Work = pool.get('project.work')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        work = Work.__table__()
+
+        companies = dict.fromkeys(map(int, contacts))
+        for sub_ids in grouped_slice(contacts):
+            cursor.execute(*table.join(work,
+                    condition=table.work == work.id
+                    ).select(table.id, work.company,
+                    where=reduce_ids(table.id, sub_ids)))
+            companies.update(cursor)
+        return companies
+
     @classmethod
     def search_company(cls, name, clause):
-        return [('work.%s' % name,) + tuple(clause[1:])]
+        pool = Pool()
+        Work = pool.get('project.work')
+        table = cls.__table__()
+        work = Work.__table__()
+
+        _, operator, value = clause[:3]
+        if operator.endswith('in'):
+            ids = isinstance(value, (list, tuple)) and all(
+                isinstance(v, int) or v is None for v in value)
+        else:
+            ids = isinstance(value, int) or value is None
+        if (clause[0] != name or not ids
+                or operator not in {'=', '!=', 'in', 'not in'}):
+            return [('work.' + clause[0],) + tuple(clause[1:])]
+        Operator = fields.SQL_OPERATORS[operator]
+        if operator.endswith('in'):
+            value = [v for v in value if v is not None]
+        query = table.join(work,
+            condition=table.work == work.id
+            ).select(table.id,
+            where=Operator(work.company, value))
+        return [('id', 'in', query)]
 
 
 class Work(metaclass=PoolMeta):
     __name__ = "project.work"
 
     contacts = fields.One2Many('project.work-party.party', 'work', 'Contacts',)
+    employee_contact = fields.Function(fields.Boolean('Employee Contact'),
+        'get_employee_contact', searcher='search_employee_contact')
+    _summary_cache = Cache('project.work.summary_mail', context=False)
 
     @classmethod
     def __setup__(cls):
         super(Work,cls).__setup__()
+        cls._mail_renderers = {}
         cls._buttons.update({
                 'send_summary': {},
                 })
 
+    @classmethod
+    def _employee_contact_query(cls):
+        '''
+        Return the query of the works that have an employee as contact
+        '''
+        WorkRecipient = Pool().get('project.work.recipient')
+        recipient = WorkRecipient.__table__()
+        return recipient.select(recipient.work,
+            where=recipient.employee == Literal(True),
+            distinct=True)
+
+    @classmethod
+    def get_employee_contact(cls, works, name):
+        cursor = Transaction().connection.cursor()
+        query = cls._employee_contact_query()
+
+        result = dict.fromkeys(map(int, works), False)
+        for sub_ids in grouped_slice(works):
+            cursor.execute(*query.select(query.work,
+                    where=reduce_ids(query.work, sub_ids)))
+            result.update((w, True) for w, in cursor)
+        return result
+
+    @classmethod
+    def search_employee_contact(cls, name, clause):
+        _, operator, value = clause
+        if operator in {'=', '!='}:
+            values = {bool(value)}
+        elif operator in {'in', 'not in'}:
+            values = {bool(v) for v in value}
+        else:
+            raise NotImplementedError(
+                'Unsupported operator "%s" on "%s"' % (operator, name))
+        if operator in {'!=', 'not in'}:
+            values = {True, False} - values
+        if values == {True, False}:
+            return []
+        elif values == {True}:
+            return [('id', 'in', cls._employee_contact_query())]
+        elif values == {False}:
+            return [('id', 'not in', cls._employee_contact_query())]
+        return [('id', '=', None)]
+
     @staticmethod
     def default_contacts():
         DefaultRule = Pool().get('project.work.default_rule')
@@ -100,6 +337,25 @@ class Work(metaclass=PoolMeta):
             'project': self.parent.id if self.parent else None,
             }
 
+    @classmethod
+    def get_ancestors(cls, work_ids):
+        '''
+        Return a dictionary with the work id as key and the list of the ids of
+        the work and its ancestors, nearest first, as value
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        result = {}
+        work_ids = [i for i in set(work_ids) if i is not None and i >= 0]
+        for sub_ids in grouped_slice(work_ids):
+            cursor.execute(*table.select(table.id, table.path,
+                    where=reduce_ids(table.id, sub_ids)))
+            for work_id, path in cursor:
+                ancestors = [int(i) for i in (path or '').split('/') if i]
+                result[work_id] = ancestors[::-1] or [work_id]
+        return result
+
     @staticmethod
     def get_mail_fields():
         # Dictionary for One2Many values
@@ -107,357 +363,957 @@ class Work(metaclass=PoolMeta):
         res = OrderedDict.fromkeys(fields)
         return res
 
-    def get_mail(self, one2many_values=None, old_values=None):
+    @classmethod
+    def get_recipients(cls, works, user=None):
         '''
-        Return Mail object or None if there are no recipients
+        Return a dictionary with the work id as key and the sorted list of
+        e-mail addresses of the contacts to notify as value.
+        The contacts notified are the ones of the recipient policy of the work,
+        by default the employees, and the employees of the user that changed
+        the work are discarded unless the user wants to receive its own
+        changes.
+        user is the id of the user that changes the works, by default the last
+        user that modified them.
+        The e-mails are read from the materialized project.work.recipient.
         '''
         pool = Pool()
+        WorkParty = pool.get('project.work-party.party')
+        WorkRecipient = pool.get('project.work.recipient')
         Employee = pool.get('company.employee')
+        RecipientPolicy = pool.get('project.work.recipient_policy')
+        User = pool.get('res.user')
+        UserEmployee = pool.get('res.user-company.employee')
+        cursor = Transaction().connection.cursor()
+        work = cls.__table__()
+        recipient = WorkRecipient.__table__()
+        own_employee = Employee.__table__()
+        user_table = User.__table__()
+        user_employee = UserEmployee.__table__()
+
+        own_changes = user_employee.join(user_table,
+            condition=user_employee.user == user_table.id
+            ).join(own_employee,
+            condition=user_employee.employee == own_employee.id
+            ).select(own_employee.id,
+            where=(user_table.id == (user if user is not None
+                    else Coalesce(work.write_uid, work.create_uid)))
+            & (Coalesce(user_table.send_own_changes, Literal(False))
+                == Literal(False))
+            & (own_employee.party == recipient.party))
+
+        policies = RecipientPolicy.get_policies([w.id for w in works])
+        conditions = {}
+        for policy in set(policies.values()):
+            if policy:
+                conditions[policy] = recipient.work_party.in_(
+                    WorkParty.search(policy.get_domain(), order=[],
+                        query=True))
+            else:
+                conditions[policy] = recipient.employee == Literal(True)
+
+        emails = defaultdict(set)
+        for sub_ids in grouped_slice([w.id for w in works]):
+            sub_policies = defaultdict(list)
+            for work_id in sub_ids:
+                sub_policies[policies[work_id]].append(work_id)
+            where = Literal(False)
+            for policy, policy_ids in sub_policies.items():
+                where |= (reduce_ids(recipient.work, policy_ids)
+                    & conditions[policy])
+            query = recipient.join(work,
+                condition=recipient.work == work.id
+                ).select(recipient.work, recipient.email,
+                where=where & (recipient.email != Null)
+                & (recipient.email != '') & ~Exists(own_changes),
+                distinct=True)
+            cursor.execute(*query)
+            for work_id, email in cursor:
+                emails[work_id].add(email)
+        return {w.id: sorted(emails[w.id]) for w in works}
 
-        if old_values is None:
-            old_values = {}
-            for field in self.get_mail_fields():
-                old_values.fromkeys(field, None)
-        if one2many_values is None:
-            one2many_values = {}
-
-        def get_value(field, value):
-            if isinstance(getattr(self.__class__, field), fields.Many2One):
-                if value:
-                    if isinstance(value, int):
-                        Model = Pool().get(getattr(self.__class__,
-                                field).model_name)
-                        value = Model(value)
-                    return value.rec_name
-            return value
-
-        to_addr = []
-        employees = [e.party.id for e in Employee.search([])]
-
-        uid = self.write_uid or self.create_uid
-        if uid:
-            discard_employees = [ce.party.id for ce in uid.employees
-                if not uid.send_own_changes]
-            employees = set(employees) - set(discard_employees)
+    @classmethod
+    def get_mail_timezone(cls):
+        '''
+        Return the timezone of the company in the context or None.
+        It is resolved once per company and transaction.
+        '''
+        Company = Pool().get('company.company')
+        transaction = Transaction()
+        company_id = transaction.context.get('company')
+        if not company_id:
+            return
+        timezones = _timezones.setdefault(transaction, {})
+        if company_id not in timezones:
+            company = Company(company_id)
+            timezones[company_id] = (pytz.timezone(company.timezone)
+                if company.timezone else None)
+        return timezones[company_id]
 
-        for contact in self.contacts:
-            party = contact.party
-            if party.id in employees and party.email:
-                to_addr.append(party.email)
-        to_addr = list(set(to_addr))
+    def get_mail_date(self, timezone=None):
+        date = self.write_date or self.create_date
+        if date and timezone:
+            date = timezone.localize(date)
+            date = date + date.utcoffset()
+        return date.strftime('%Y-%m-%d %H:%M') if date else '/'
 
+    def get_mail(self, one2many_values=None, old_values=None, to_addr=None,
+            timezone=None):
+        '''
+        Return Mail object or None if there are no recipients
+        '''
+        if to_addr is None:
+            to_addr = self.get_recipients([self])[self.id]
         if not to_addr:
             return
 
-        url = '%s/model/project.work/%s' % (URL, getattr(self,'id'))
-        name = self.rec_name
-
-        body = []
-        body.append(u'<div style="background: #EEEEEE; padding-left: 10px; '
-                'padding-bottom: 10px">'
-                '<a href="%(url)s">'
-                '<h2 style="margin: 0px 0px 0px 0px; '
-                'padding: 0px 0px 0px 0px;">%(name)s</h2>'
-                '</a>' % {
-                'url':url,
-                'name' : name,
-                })
-
-        for field, subfields in self.get_mail_fields().items():
-            if old_values.get(field) == getattr(self, field):
-                continue
-            diff=[]
-            if isinstance(getattr(self.__class__, field), fields.Text):
-                old = old_values.get(field) or ''
-                old = old.splitlines(1)
-                new = getattr(self, field) or ''
-                new = new.splitlines(1)
-                diffs = difflib.unified_diff(old, new, n=3)
-                title = ' '.join([x.capitalize() for x in field.split('_')])
-                body.append(u'<br><b>{}</b>:'.format(title))
-                for diff in diffs:
-                    diff = html.escape(diff)
-                    if (diff.startswith('@') or diff.startswith('+++')
-                            or diff.startswith('---')):
-                        continue
-                    if (diff.startswith('-')):
-                        body.append(u'<font color="red">%s</font>' %
-                            diff.rstrip('\n'))
-                        continue
-                    if (diff.startswith('+')):
-                        body.append(u'<font color="green">%s</font>' %
-                            diff.rstrip('\n'))
-                        continue
-                    else:
-                        body.append(diff.rstrip('\n'))
-                        continue
-            elif isinstance(getattr(self.__class__, field), fields.One2Many):
-                related_model = Pool().get(getattr(self.__class__,
-                            field).model_name)
-                for one2many in one2many_values.get(field, []):
-                    for subfield in subfields:
-                        if isinstance(getattr(related_model, subfield),
-                                fields.Text):
-                            texts = one2many.get(subfield) or ''
-                            texts = texts.splitlines(1)
-                            title = ' '.join([x.capitalize() for x in subfield.split('_')])
-                            body.append(u'<b>{}</b>:'.format(title))
-                            for text in texts:
-                                text = html.escape(text)
-                                body.append(text)
-                        elif isinstance(getattr(related_model, subfield),
-                                fields.DateTime):
-                            date = one2many.get(subfield)
-                            date = date.strftime('%Y-%m-%d %H:%M') if date else '/'
-                            title = ' '.join([x.capitalize() for x in subfield.split('_')])
-                            body.append(u'<b>{}</b>: {}'.format(title,date))
-                        elif isinstance(getattr(related_model, subfield),
-                                fields.Many2One):
-                            Model = Pool().get(getattr(related_model,
-                                    subfield).model_name)
-                            value = Model(one2many.get(subfield))
-                            title = ' '.join([x.capitalize() for x in subfield.split('_')])
-                            body.append(u'<b>{}</b>: {}'.format(title,value.rec_name))
-                        else:
-                            title = ' '.join([x.capitalize() for x in subfield.split('_')])
-                            body.append(u'<b>{}</b>: {}'.format(title,one2many.get(subfield)))
-                    body.append(u'<br><hr style="border-top: 1px dashed;">')
-            else:
-                title = ' '.join([x.capitalize() for x in field.split('_')])
-                body.append(u'<b>{}</b>:'.format(title))
-                if field in old_values:
-                    body.append(u'<font color="red">- {} </font>'.format(
-                        get_value(field, old_values[field])))
-                body.append(u'<font color="green"> + {} </font>'.format(
-                    get_value(field, getattr(self, field))))
-
-        Company = pool.get('company.company')
-        company_id = Transaction().context.get('company')
-        date = self.write_date or self.create_date
-        if company_id:
-            company = Company(company_id)
-            if company.timezone:
-                timezone = pytz.timezone(company.timezone)
-                date = timezone.localize(date)
-                date = date + date.utcoffset()
-
-        date = date.strftime('%Y-%m-%d %H:%M') if date else '/'
-        body.append('<br>'
-                    '<small>'
-                    '%(operation)s by %(write_user)s on %(write_date)s'
-                    '</small>' % {
-                    'operation': 'Updated' if old_values else 'Created',
-                    'write_user': uid.name,
-                    'write_date' : date,
-                    })
-
-        body.append(u'</div>')
-        body = u'<br/>\n'.join(body)
-        body = u'''<html><head>
-            <meta http-equiv="Content-Type" content="text/html;charset=utf-8">
-            </head>
-            <body style="font-family: courier">%s</body>
-            </html>''' % body
+        body = HTML % self.get_mail_body(one2many_values, old_values,
+            timezone=timezone)
 
         msg = MIMEText(body, 'html',_charset='utf-8')
         msg['From'] = FROM_ADDR
         msg['To'] = ', '.join(to_addr)
         msg['Subject'] = Header(u"Changes in %s" % self.rec_name, 'utf-8')
 
-        url = urlparse(url)
         if old_values:
-            msg['In-Reply-To'] = "<{}@{}>".format(self.id, url.netloc)
+            msg['In-Reply-To'] = "<{}@{}>".format(self.id, NETLOC)
         return msg
 
+    def get_mail_body(self, one2many_values=None, old_values=None,
+            timezone=None):
+        '''
+        Return the HTML block with the changes of the work
+        '''
+        if timezone is None:
+            timezone = self.get_mail_timezone()
+        if old_values is None:
+            old_values = {}
+        if one2many_values is None:
+            one2many_values = {}
+
+        mail_fields, values, display_old_values, rows = [], {}, {}, {}
+        for field, kind, subfields, convert in self.get_mail_renderers():
+            if old_values and field not in old_values:
+                continue
+            if (not one2many_values.get(field)
+                    and old_values.get(field)
+                    == mail_value(getattr(self, field))):
+                continue
+            mail_fields.append((field, kind, subfields))
+            if kind == 'one2many':
+                rows[field] = map(convert, one2many_values.get(field, []))
+                continue
+            values[field] = convert(getattr(self, field))
+            if field in old_values:
+                display_old_values[field] = convert(old_values[field])
+        uid = self.write_uid or self.create_uid
+        return render_change(self.rec_name,
+            '%s/model/project.work/%s' % (URL, self.id), mail_fields,
+            values, display_old_values if old_values else None, rows,
+            user=uid.name, date=self.get_mail_date(timezone),
+            max_rows=ONE2MANY_MAX_LINES, **DIFF_OPTIONS)
+
+    @classmethod
+    def get_mail_renderers(cls):
+        '''
+        Return the list of (field, kind, subfields, convert) of the mail fields
+        for render_change and render_summary where convert returns the value
+        of the field, or the One2Many row, converted for display.
+        '''
+        key = tuple((f, tuple(s) if s else s)
+            for f, s in cls.get_mail_fields().items())
+        renderers = cls._mail_renderers.get(key)
+        if renderers is None:
+            renderers = cls._mail_renderers[key] = [
+                (f,) + cls.get_mail_renderer(f, s)
+                for f, s in cls.get_mail_fields().items()]
+        return renderers
+
+    @classmethod
+    def get_mail_renderer(cls, name, subfields=None):
+        '''
+        Return the kind, the subfields and the conversion function of the mail
+        field name
+        '''
+        field = getattr(cls, name)
+        if isinstance(field, fields.Text):
+            return 'text', None, mail_getter(field)
+        elif isinstance(field, fields.One2Many):
+            Target = Pool().get(field.model_name)
+            subfields = [(s,) + cls.get_mail_subfield(Target, s)
+                for s in subfields or []]
+            getters = [(s, g) for s, _, g in subfields if g]
+
+            def convert(values):
+                if '_omitted' in values or not getters:
+                    return values
+                values = values.copy()
+                for subfield, get_value in getters:
+                    if subfield in values or '_action' not in values:
+                        values[subfield] = get_value(values.get(subfield))
+                return values
+            return 'one2many', [(s, k) for s, k, _ in subfields], convert
+        return 'value', None, mail_getter(field)
+
+    @classmethod
+    def get_mail_subfield(cls, Target, name):
+        '''
+        Return the kind of the field name of the One2Many target model for
+        render_change and the function that converts its values for display or
+        None
+        '''
+        field = getattr(Target, name)
+        if isinstance(field, fields.Text):
+            return 'text', None
+        elif isinstance(field, fields.DateTime):
+            return 'datetime', None
+        elif isinstance(field, fields.Many2One):
+            Model = Pool().get(field.model_name)
+
+            def get_value(value):
+                if value is not None:
+                    return get_rec_names(Model, [value])[value]
+                return Model(value).rec_name
+            return 'value', get_value
+        return 'value', None
+
     @classmethod
     def create(cls, vlist):
-        records = super(Work, cls).create(vlist)
-        for record in records:
-            for values in vlist:
-                email = record.get_mail()
-                if email:
-                    record.send_mail(email)
+        with operation('create'):
+            records = super(Work, cls).create(vlist)
+            if records:
+                if QUEUE:
+                    cls.__queue__.send_change_mails(records)
+                else:
+                    cls.send_change_mails(records)
         return records
 
     @classmethod
     def write(cls, *args):
         pool = Pool()
         ModelData = pool.get('ir.model.data')
+        MailChange = pool.get('project.work.mail_change')
 
-        actions = iter(args)
-        args = []
-        status_done_id = ModelData.get_id('project', 'work_done_status')
+        with operation('write'):
+            actions = iter(args)
+            args = []
+            status_done_id = ModelData.get_id('project', 'work_done_status')
 
-        old_values = {}
-        to_addr = []
-        ready_to_send_summary = []
-        check_in_email_fields = []
-        one2many_values = {}
-        for records, values in zip(actions, actions):
-            if values.get('status') == status_done_id:
-                ready_to_send_summary += records
-
-            if set(values.keys()) & set(cls.get_mail_fields()):
+            user = Transaction().user
+            mail_fields = cls.get_mail_fields()
+            old_values = {}
+            ready_to_send_summary = []
+            check_in_email_fields = []
+            one2many_values = {}
+            for records, values in zip(actions, actions):
+                args.extend((records, values))
+                if values.get('status') == status_done_id:
+                    ready_to_send_summary += records
+
+                changed = [f for f in mail_fields if f in values]
+                if not changed:
+                    continue
+                if 'contacts' not in values:
+                    # Only the works with recipients are mailed
+                    with stage('recipients'):
+                        recipients = cls.get_recipients(records, user=user)
+                    records = [r for r in records if recipients[r.id]]
+                if not records:
+                    continue
                 check_in_email_fields += records
 
-            for record in records:
-                old_values[record.id] = {}
-                for field in cls.get_mail_fields():
-                    old_values[record.id][field] = getattr(record, field)
-
-                    if isinstance(getattr(record.__class__, field),
-                        fields.One2Many):
-
-                        if not field in values:
-                            continue
-                        if values[field][0][0] != 'create':
-                            continue
+                with stage('snapshot'):
+                    for record_values in cls.read(
+                            [r.id for r in records], changed):
+                        record_old_values = old_values.setdefault(
+                            record_values.pop('id'), {})
+                        for field, value in record_values.items():
+                            record_old_values.setdefault(field, value)
+
+                for field in changed:
+                    if isinstance(getattr(cls, field), fields.One2Many):
+                        for record in records:
+                            cls.add_one2many_changes(field, values[field],
+                                one2many_values.setdefault(
+                                    record.id, {}).setdefault(field, []))
+
+            super(Work, cls).write(*args)
+
+            if check_in_email_fields:
+                if COALESCE or DIGEST:
+                    MailChange.add(check_in_email_fields, old_values,
+                        one2many_values)
+                elif QUEUE:
+                    cls.__queue__.send_change_mails(check_in_email_fields,
+                        old_values, one2many_values)
+                else:
+                    cls.send_change_mails(check_in_email_fields, old_values,
+                        one2many_values)
+
+            if ready_to_send_summary:
+                cls._send_summaries(list(dict.fromkeys(ready_to_send_summary)))
 
-                        for one2many_list in values[field][0][1]:
-                            one2many_values.setdefault(field, []).append(
-                                one2many_list)
-
-            for work in records:
-                for contact in work.contacts:
-                    party = contact.party
-                    to_addr.append(party.email)
-            args.extend((records, values))
+    @classmethod
+    def add_one2many_changes(cls, name, actions, changes):
+        '''
+        Append to changes the values of the lines changed by the actions on
+        the One2Many field name.
+        The created lines are their values and the other lines have also the
+        _action and the _rec_name keys. Above ONE2MANY_MAX_LINES, the lines
+        are only counted by an {'_omitted': number} item.
+        '''
+        Target = Pool().get(getattr(cls, name).model_name)
+
+        def lines():
+            for action in actions:
+                if action[0] == 'create':
+                    yield from action[1]
+                elif action[0] == 'write':
+                    writes = iter(action[1:])
+                    for ids, values in zip(writes, writes):
+                        for id_ in ids:
+                            yield dict(values, _action='write', id=id_)
+                elif action[0] in {'delete', 'remove', 'add'}:
+                    for id_ in action[1]:
+                        yield {'_action': action[0], 'id': id_}
+
+        available = max(ONE2MANY_MAX_LINES
+            - sum(1 for c in changes if '_omitted' not in c), 0)
+        added = []
+        omitted = 0
+        for line in lines():
+            if len(added) < available:
+                added.append(line)
+            else:
+                omitted += 1
+        # The rec_names are read before the lines are deleted
+        rec_names = get_rec_names(Target,
+            [l['id'] for l in added if '_action' in l])
+        for line in added:
+            if '_action' in line:
+                line['_rec_name'] = rec_names.get(line['id'])
+        changes.extend(added)
+        if omitted:
+            changes.append({'_omitted': omitted})
 
-        super(Work, cls).write(*args)
+    @classmethod
+    def send_change_mails(cls, works, old_values=None, one2many_values=None):
+        '''
+        Send the mails of the changes of the works.
+        old_values is a dictionary with the work id as key and the values of
+        the mail fields before the changes as value, or None if the works are
+        new.
+        one2many_values is a dictionary with the work id as key and the
+        changed lines by One2Many field as value.
+        '''
+        # Keys are strings when the call comes from the queue
+        if old_values is not None:
+            old_values = {int(k): v for k, v in old_values.items()}
+        if one2many_values is not None:
+            one2many_values = {int(k): v for k, v in one2many_values.items()}
+        else:
+            one2many_values = {}
+        with operation('send_change_mails'):
+            with stage('recipients'):
+                recipients = cls.get_recipients(works)
+            with stage('render'):
+                timezone = cls.get_mail_timezone()
+                cls.prefetch_mail_rec_names(
+                    [w for w in works if recipients[w.id]],
+                    old_values, one2many_values)
+                messages = []
+                for work in works:
+                    email = work.get_mail(one2many_values.get(work.id),
+                        old_values[work.id] if old_values is not None
+                        else None,
+                        to_addr=recipients[work.id], timezone=timezone)
+                    if email:
+                        messages.append((work, email))
+            cls.send_mails(messages)
 
-        actions = iter(args)
-        for record in check_in_email_fields:
-            email = record.get_mail(one2many_values, old_values[record.id])
-            if email:
-                record.send_mail(email)
+    @classmethod
+    def send_summary_mails(cls, works):
+        '''
+        Send the summary mails of the works.
+        Return the number of mails sent and of works skipped.
+        '''
+        with operation('send_summary_mails'):
+            with stage('recipients'):
+                recipients = cls.get_recipients(works)
+            with stage('render'):
+                timezone = cls.get_mail_timezone()
+                cls.prefetch_mail_rec_names(
+                    [w for w in works if recipients[w.id]
+                        and not cls._summary_cache.get(
+                            w.get_summary_key(timezone))])
+                messages = [(w, w.get_summary_mail(to_addr=recipients[w.id],
+                            timezone=timezone)) for w in works]
+            sent = cls.send_mails(messages)
+        logger.info('Sent %s summary mails, skipped %s works',
+            sent, len(works) - sent)
+        return sent, len(works) - sent
 
-        for work in ready_to_send_summary:
-            work.send_summary_mail()
+    @classmethod
+    def prefetch_mail_rec_names(cls, works, old_values=None,
+            one2many_values=None):
+        '''
+        Read with one call per model the rec_name of the records referenced
+        by the Many2One mail fields of the works, their old values and the
+        new One2Many lines.
+        old_values and one2many_values are dictionaries with the work id as
+        key.
+        '''
+        pool = Pool()
+        if old_values is None:
+            old_values = {}
+        if one2many_values is None:
+            one2many_values = {}
+        ids = defaultdict(set)
+        for name, subfields in cls.get_mail_fields().items():
+            field = getattr(cls, name)
+            if isinstance(field, fields.Many2One):
+                model_ids = ids[field.model_name]
+                for work in works:
+                    model_ids.add(mail_value(getattr(work, name)))
+                    model_ids.add(old_values.get(work.id, {}).get(name))
+            elif isinstance(field, fields.One2Many):
+                Target = pool.get(field.model_name)
+                for subfield in subfields or []:
+                    target_field = getattr(Target, subfield)
+                    if isinstance(target_field, fields.Many2One):
+                        model_ids = ids[target_field.model_name]
+                        for work in works:
+                            for values in one2many_values.get(
+                                    work.id, {}).get(name, []):
+                                model_ids.add(values.get(subfield))
+        for model_name, model_ids in ids.items():
+            get_rec_names(pool.get(model_name), model_ids)
 
     def get_summary_contacts_pattern(self):
         return {
             'project': self.parent.id if self.parent else None,
             }
 
-    def get_summary_mail(self):
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        super().on_modification(mode, records, field_names=field_names)
+        _modified_works.setdefault(Transaction(), set()).update(
+            r.id for r in records)
+
+    def get_summary_key(self, timezone=None):
         '''
-        Return Mail object or None if there are no recipients
+        Return the key of the cached summary of the work or None if the work
+        is modified by the transaction as its write_date stays the same
         '''
+        transaction = Transaction()
+        if self.id in _modified_works.get(transaction, ()):
+            return
+        return (self.id, self.write_date or self.create_date,
+            transaction.language, str(timezone) if timezone else None)
 
-        Employee = Pool().get('company.employee')
-        Company = Pool().get('company.company')
+    def get_summary_mail(self, to_addr=None, timezone=None):
+        '''
+        Return Mail object or None if there are no recipients.
+        The rendered summary is cached until the work is modified.
+        '''
+        if to_addr is None:
+            to_addr = self.get_recipients([self])[self.id]
+        if not to_addr:
+            return
+        if timezone is None:
+            timezone = self.get_mail_timezone()
+
+        key = self.get_summary_key(timezone)
+        summary = self._summary_cache.get(key) if key else None
+        if summary is None:
+            summary = (self.rec_name, self.get_summary_body(timezone))
+            if key:
+                self._summary_cache.set(key, summary)
+        rec_name, body = summary
 
-        to_addr = []
-        employees = [e.party.id for e in Employee.search([])]
+        msg = MIMEText(body, 'html',_charset='utf-8')
+        msg['From'] = FROM_ADDR
+        msg['To'] = ', '.join(to_addr)
+        msg['Subject'] = Header(u'Summary of %s' % rec_name, 'utf-8')
+
+        msg['In-Reply-To'] = "<{}@{}>".format(self.id, NETLOC)
+        return msg
 
+    def get_summary_body(self, timezone=None):
+        'Return the HTML of the summary of the work'
+        mail_fields, values = [], {}
+        for field, kind, _, convert in self.get_mail_renderers():
+            if kind != 'one2many':
+                mail_fields.append((field, kind))
+                values[field] = convert(getattr(self, field))
         uid = self.write_uid or self.create_uid
-        if uid:
-            discard_employees = [ce.party.id for ce in uid.employees
-                if not uid.send_own_changes]
-            employees = set(employees) - set(discard_employees)
+        return render_summary(self.rec_name,
+            '%s/model/project.work/%s' % (URL, self.id), mail_fields, values,
+            user=uid.name, date=self.get_mail_date(timezone))
 
-        for contact in self.contacts:
-            party = contact.party
-            if party.id in employees and party.email:
-                to_addr.append(party.email)
+    def send_summary_mail(self, to_addr=None, timezone=None):
+        msg = self.get_summary_mail(to_addr=to_addr, timezone=timezone)
+        self.send_mails([(self, msg)])
 
-        to_addr = list(set(to_addr))
-        if not to_addr:
-            return
+    def send_mail(self, msg):
+        self.send_mails([(self, msg)])
 
-        def get_value(field, value):
-            if isinstance(getattr(self.__class__, field), fields.Many2One):
-                if value:
-                    if isinstance(value, int):
-                        Model = Pool().get(getattr(self.__class__,
-                                field).model_name)
-                        value = Model(value)
-                    return value.rec_name
-            return value
+    @classmethod
+    def send_mails(cls, messages):
+        '''
+        Send the mails of the list of (work, mail) threaded with the previous
+        mails of the work and log them.
+        The mails identical to one sent to the same recipients within the
+        dedupe window are skipped.
+        Return the number of mails sent.
+        '''
+        pool = Pool()
+        MailLog = pool.get('project.work.mail_log')
+
+        to_send = []
+        for work, msg in messages:
+            if not msg or not msg['To']:
+                continue
+            to_addr = [x.strip() for x in msg['To'].split(',')]
+            to_addr = [x for x in to_addr if x]
+            if not to_addr:
+                continue
+            content_hash = hashlib.sha256(('%s\n%s' % (
+                        msg['Subject'], msg.get_payload())).encode('utf-8')
+                ).hexdigest()
+            to_send.append(
+                (work, msg, to_addr, ', '.join(sorted(to_addr)), content_hash))
+        if not to_send:
+            return 0
+
+        work_ids = {w.id for w, _, _, _, _ in to_send}
+        threads = MailLog.get_threads(work_ids)
+        sent = set()
+        if DEDUPE:
+            sent = MailLog.get_sent(work_ids, datetime.datetime.now()
+                - datetime.timedelta(seconds=DEDUPE))
+
+        logs = []
+        for work, msg, to_addr, recipients, content_hash in to_send:
+            key = (work.id, recipients, content_hash)
+            if key in sent:
+                continue
+            sent.add(key)
+
+            root = '<{}@{}>'.format(work.id, NETLOC)
+            if work.id in threads:
+                message_id, thread = threads[work.id]
+                references = thread.split() + [message_id]
+                references = references[:1] + references[1:][-REFERENCES_MAX:]
+            elif msg['In-Reply-To']:
+                references = [root]
+            else:
+                references = []
+            if references:
+                message_id = '<{}.{}@{}>'.format(
+                    work.id, uuid.uuid4().hex, NETLOC)
+            else:
+                message_id = root
+            del msg['Message-ID']
+            del msg['In-Reply-To']
+            del msg['References']
+            msg['Message-ID'] = message_id
+            if references:
+                msg['In-Reply-To'] = references[-1]
+                msg['References'] = ' '.join(references)
+
+            with stage('handoff'):
+                sendmail_transactional(msg['From'], to_addr, msg)
+            incr('messages')
+            incr('bytes', len(msg.get_payload()))
+            threads[work.id] = (message_id, ' '.join(references))
+            logs.append({
+                    'work': work.id,
+                    'message_id': message_id,
+                    'thread': ' '.join(references),
+                    'recipients': recipients,
+                    'content_hash': content_hash,
+                    })
+        MailLog.create(logs)
+        return len(logs)
 
-        url = '%s/model/project.work/%s' % (URL, getattr(self,'id'))
-        name = self.rec_name
+    @classmethod
+    @ModelView.button
+    def send_summary(cls, works):
+        cls._send_summaries(works)
 
-        body = []
+    @classmethod
+    def _send_summaries(cls, works):
+        '''
+        Send the summary mails of the works in one batch or, with the queue,
+        in tasks of SUMMARY_CHUNK works rendered in parallel by the workers.
+        Return the number of mails sent and of works skipped or None if the
+        mails are queued.
+        '''
+        if QUEUE:
+            for sub_works in grouped_slice(works, SUMMARY_CHUNK):
+                cls.__queue__.send_summary_mails(list(sub_works))
+        else:
+            return cls.send_summary_mails(works)
+
+    @classmethod
+    def apply_default_rules(cls, works, children=False):
+        '''
+        Add to the works the contacts of the default rules they are missing.
+        If children is set, the rules are also applied to all the descendants
+        of the works.
+        Return the number of contacts added.
+        '''
+        pool = Pool()
+        DefaultRule = pool.get('project.work.default_rule')
+        WorkParty = pool.get('project.work-party.party')
+        cursor = Transaction().connection.cursor()
+        table = WorkParty.__table__()
+
+        if children:
+            works = cls.search([('parent', 'child_of', [w.id for w in works])])
+        works = cls.browse(sorted({w.id for w in works}))
+
+        rules_contacts = {}
+        count = 0
+        for i, sub_works in enumerate(
+                grouped_slice(works, APPLY_RULES_CHUNK)):
+            sub_works = list(sub_works)
+            existing = set()
+            for sub_ids in grouped_slice([w.id for w in sub_works]):
+                cursor.execute(*table.select(table.work, table.party,
+                        where=reduce_ids(table.work, sub_ids)))
+                existing.update(cursor)
+
+            to_create = []
+            for work in sub_works:
+                pattern = work.get_default_rule_pattern()
+                key = tuple(sorted(pattern.items()))
+                if key not in rules_contacts:
+                    rules_contacts[key] = list(dict.fromkeys(
+                            p.id for p in DefaultRule.compute(pattern)))
+                allowed = set(WorkParty.get_allowed_contacts(work.company.id,
+                        work.party.id if work.party else None))
+                for party in rules_contacts[key]:
+                    if (work.id, party) in existing or party not in allowed:
+                        continue
+                    existing.add((work.id, party))
+                    to_create.append({
+                            'work': work.id,
+                            'party': party,
+                            })
+            if to_create:
+                WorkParty.create(to_create)
+            count += len(to_create)
+            logger.info('Applied default rules to %s/%s works',
+                min((i + 1) * APPLY_RULES_CHUNK, len(works)), len(works))
+        return count
+
+
+class WorkRecipient(ModelSQL):
+    'Work Recipient'
+    __name__ = 'project.work.recipient'
+
+    work_party = fields.Many2One('project.work-party.party', 'Work Contact',
+        required=True, ondelete='CASCADE')
+    work = fields.Many2One('project.work', 'Work', required=True,
+        ondelete='CASCADE')
+    party = fields.Many2One('party.party', 'Party', required=True,
+        ondelete='CASCADE')
+    email = fields.Char('E-Mail')
+    employee = fields.Boolean('Employee')
 
-        body.append(u'<div style="background: #EEEEEE; padding-left: 10px; '
-                'padding-bottom: 10px">'
-                '<a href="%(url)s">'
-                '<h2 style="margin: 0px 0px 0px 0px; '
-                'padding: 0px 0px 0px 0px;"> %(name)s </h2>'
-                '</a>'
-                % {
-                'url':url,
-                'name' : name,
+    @classmethod
+    def __setup__(cls):
+        super(WorkRecipient, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.work, Index.Equality())),
+                Index(t, (t.party, Index.Equality())),
+                Index(t, (t.work_party, Index.Equality())),
                 })
 
-        for field in self.get_mail_fields():
-            if isinstance(getattr(self.__class__, field), fields.One2Many):
-                continue
-            elif isinstance(getattr(self.__class__, field), fields.Text):
-                texts = getattr(self, field) or ''
-                texts = texts.splitlines(1)
-                title = ' '.join([x.capitalize() for x in field.split('_')])
-                body.append(u'<b>{}</b>:'.format(title))
-                for text in texts:
-                    text = html.escape(text)
-                    body.append(text)
-            else:
-                title = ' '.join([x.capitalize() for x in field.split('_')])
-                body.append(u'<b>{}</b>: {}'.format(title,get_value(field,
-                            getattr(self, field))))
+    @classmethod
+    def __register__(cls, module_name):
+        exist = backend.TableHandler.table_exist(cls._table)
+        super(WorkRecipient, cls).__register__(module_name)
+        if not exist:
+            cls.rebuild()
 
+    @classmethod
+    def rebuild(cls):
+        'Fill the table with the recipients of all the work contacts'
+        pool = Pool()
+        WorkParty = pool.get('project.work-party.party')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        work_party = WorkParty.__table__()
 
-        company_id = Transaction().context.get('company')
-        date = self.write_date or self.create_date
-        if company_id:
-            company = Company(company_id)
-            if company.timezone:
-                timezone = pytz.timezone(company.timezone)
-                date = timezone.localize(date)
-                date = date + date.utcoffset()
-
-        date = date.strftime('%Y-%m-%d %H:%M') if date else '/'
-        body.append('<br>'
-                    '<small>'
-                    'Closed by %(write_user)s on %(write_date)s'
-                    '</small>' % {
-                    'write_user': uid.name,
-                    'write_date' : date,
-                    })
+        cursor.execute(*table.delete())
+        cursor.execute(*work_party.select(work_party.id))
+        cls.update_work_parties([i for i, in cursor])
 
-        body.append(u'</div>')
-        body = u'<br/>\n'.join(body)
-        body = u'''<html><head>
-            <meta http-equiv="Content-Type" content="text/html;charset=utf-8">
-            </head>
-            <body style="font-family: courier">%s</body>
-            </html>''' % body
+    @classmethod
+    def update_work_parties(cls, work_party_ids):
+        '''
+        Replace the recipients of the work contacts by their current party,
+        e-mail and employee flag
+        '''
+        pool = Pool()
+        WorkParty = pool.get('project.work-party.party')
+        Employee = pool.get('company.employee')
+        Party = pool.get('party.party')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        work_party = WorkParty.__table__()
+        employee = Employee.__table__()
+
+        rows = []
+        for sub_ids in grouped_slice(list(set(work_party_ids))):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.work_party, sub_ids)))
+            cursor.execute(*work_party.select(
+                    work_party.id, work_party.work, work_party.party,
+                    where=reduce_ids(work_party.id, sub_ids)))
+            rows.extend(cursor)
+        if not rows:
+            return
 
-        msg = MIMEText(body, 'html',_charset='utf-8')
-        msg['From'] = FROM_ADDR
-        msg['To'] = ', '.join(to_addr)
-        msg['Subject'] = Header(u'Summary of %s' % self.rec_name, 'utf-8')
+        party_ids = list({r[2] for r in rows})
+        employees = set()
+        for sub_ids in grouped_slice(party_ids):
+            cursor.execute(*employee.select(employee.party,
+                    where=reduce_ids(employee.party, sub_ids)))
+            employees.update(p for p, in cursor)
+        emails = {p['id']: p['email']
+            for p in Party.read(party_ids, ['email'])}
+
+        columns = [table.work_party, table.work, table.party, table.email,
+            table.employee, table.create_uid, table.create_date]
+        for sub_rows in grouped_slice(rows):
+            cursor.execute(*table.insert(columns, [[
+                            id_, work, party, emails[party] or None,
+                            party in employees, transaction.user,
+                            CurrentTimestamp()]
+                        for id_, work, party in sub_rows]))
 
-        url = urlparse(url)
-        msg['In-Reply-To'] = "<{}@{}>".format(self.id, url.netloc)
-        return msg
+    @classmethod
+    def update_parties(cls, party_ids):
+        'Update the recipients of the work contacts of the parties'
+        pool = Pool()
+        WorkParty = pool.get('project.work-party.party')
+        cursor = Transaction().connection.cursor()
+        work_party = WorkParty.__table__()
 
-    def send_summary_mail(self):
-        msg = self.get_summary_mail()
-        if msg and msg['To']:
-            to_addr = [x.strip() for x in msg['To'].split(',')]
-            if to_addr:
-                sendmail_transactional(msg['From'], to_addr, msg)
+        work_party_ids = []
+        for sub_ids in grouped_slice(list(set(party_ids))):
+            cursor.execute(*work_party.select(work_party.id,
+                    where=reduce_ids(work_party.party, sub_ids)))
+            work_party_ids.extend(i for i, in cursor)
+        cls.update_work_parties(work_party_ids)
 
-    def send_mail(self, msg):
-        if msg and msg['To']:
-            to_addr = [x.strip() for x in msg['To'].split(',')]
-            if to_addr:
-                sendmail_transactional(msg['From'], to_addr, msg)
+
+class WorkMailChange(ModelSQL):
+    'Work Mail Change'
+    __name__ = 'project.work.mail_change'
+
+    work = fields.Many2One('project.work', 'Work', required=True,
+        ondelete='CASCADE')
+    # Nested in a dictionary as Dict fields do not store the None values
+    data = fields.Dict(None, 'Data')
 
     @classmethod
-    @ModelView.button
-    def send_summary(cls, works):
+    def add(cls, works, old_values, one2many_values):
+        '''
+        Merge the changes of the works into their pending change.
+        The old values of the oldest change are kept and the new One2Many
+        lines are appended.
+        '''
+        changes = {c.work.id: c for c in cls.search([
+                    ('work', 'in', [w.id for w in works]),
+                    ])}
         for work in works:
-            work.send_summary_mail()
+            change = changes.get(work.id)
+            if change:
+                work_old_values = old_values[work.id].copy()
+                work_old_values.update(change.old_values)
+                work_one2many_values = change.one2many_values.copy()
+                for field, lines in one2many_values.get(
+                        work.id, {}).items():
+                    work_one2many_values[field] = (
+                        work_one2many_values.get(field, []) + lines)
+                change.data = {
+                    'old_values': work_old_values,
+                    'one2many_values': work_one2many_values,
+                    }
+            else:
+                changes[work.id] = cls(work=work, data={
+                        'old_values': old_values[work.id],
+                        'one2many_values': one2many_values.get(work.id, {}),
+                        })
+        cls.save(list(changes.values()))
+
+    @property
+    def old_values(self):
+        return self.data['old_values']
+
+    @property
+    def one2many_values(self):
+        return self.data['one2many_values']
+
+    @classmethod
+    def send_pending(cls):
+        '''
+        Send one mail per work for the changes older than the coalescing
+        window
+        '''
+        pool = Pool()
+        Work = pool.get('project.work')
+        if DIGEST or not COALESCE:
+            return
+        date = datetime.datetime.now() - datetime.timedelta(seconds=COALESCE)
+        changes = cls.search([
+                ('create_date', '<=', date),
+                ])
+        for change in changes:
+            Work.send_change_mails([change.work],
+                {change.work.id: change.old_values},
+                {change.work.id: change.one2many_values})
+        cls.delete(changes)
+
+    @classmethod
+    def send_digest(cls):
+        '''
+        Send to each recipient one mail with the pending changes of all its
+        works
+        '''
+        pool = Pool()
+        Work = pool.get('project.work')
+        if not DIGEST:
+            return
+        changes = cls.search([])
+        works = [c.work for c in changes]
+        recipients = Work.get_recipients(works)
+        timezone = Work.get_mail_timezone()
+        Work.prefetch_mail_rec_names(works,
+            {c.work.id: c.old_values for c in changes},
+            {c.work.id: c.one2many_values for c in changes})
+
+        bodies = {}
+        to_changes = defaultdict(list)
+        for change in changes:
+            for to_addr in recipients[change.work.id]:
+                to_changes[to_addr].append(change)
+        for to_addr, addr_changes in to_changes.items():
+            body = []
+            for change in addr_changes:
+                if change.id not in bodies:
+                    bodies[change.id] = change.work.get_mail_body(
+                        change.one2many_values, change.old_values,
+                        timezone=timezone)
+                body.append(bodies[change.id])
+            body = HTML % u'<br/>\n'.join(body)
+
+            msg = MIMEText(body, 'html', _charset='utf-8')
+            msg['From'] = FROM_ADDR
+            msg['To'] = to_addr
+            msg['Subject'] = Header(u'Changes in %s works' % len(
+                    {c.work.id for c in addr_changes}), 'utf-8')
+            sendmail_transactional(FROM_ADDR, [to_addr], msg)
+        cls.delete(changes)
+
+
+class WorkMailLog(ModelSQL):
+    'Work Mail Log'
+    __name__ = 'project.work.mail_log'
+
+    work = fields.Many2One('project.work', 'Work', required=True,
+        ondelete='CASCADE')
+    message_id = fields.Char('Message-ID', required=True)
+    thread = fields.Text('References')
+    recipients = fields.Text('Recipients')
+    content_hash = fields.Char('Content Hash')
+
+    @classmethod
+    def __setup__(cls):
+        super(WorkMailLog, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.work, Index.Equality())))
+
+    @classmethod
+    def get_threads(cls, work_ids):
+        '''
+        Return a dictionary with the work id as key and the Message-ID and
+        the References of the last mail of the work as value
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        log_ids = []
+        for sub_ids in grouped_slice(work_ids):
+            cursor.execute(*table.select(Max(table.id),
+                    where=reduce_ids(table.work, sub_ids),
+                    group_by=table.work))
+            log_ids.extend(i for i, in cursor)
+        result = {}
+        for sub_ids in grouped_slice(log_ids):
+            cursor.execute(*table.select(
+                    table.work, table.message_id, table.thread,
+                    where=reduce_ids(table.id, sub_ids)))
+            result.update((w, (m, t or '')) for w, m, t in cursor)
+        return result
+
+    @classmethod
+    def get_sent(cls, work_ids, date):
+        '''
+        Return the set of (work id, recipients, content hash) of the mails
+        sent since the date
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        result = set()
+        for sub_ids in grouped_slice(work_ids):
+            cursor.execute(*table.select(
+                    table.work, table.recipients, table.content_hash,
+                    where=reduce_ids(table.work, sub_ids)
+                    & (table.create_date >= date)))
+            result.update(cursor)
+        return result
+
+
+class ApplyDefaultRulesStart(ModelView):
+    'Apply Default Rules Start'
+    __name__ = 'project.work.apply_default_rules.start'
+
+    children = fields.Boolean('Include Children',
+        help='Apply the default rules also to the descendants of the works.')
+
+    @staticmethod
+    def default_children():
+        return True
+
+
+class ApplyDefaultRules(Wizard):
+    'Apply Default Rules'
+    __name__ = 'project.work.apply_default_rules'
+
+    start = StateView('project.work.apply_default_rules.start',
+        'project_contact.apply_default_rules_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Apply', 'apply', 'tryton-ok', default=True),
+            ])
+    apply = StateTransition()
+
+    def transition_apply(self):
+        pool = Pool()
+        Work = pool.get('project.work')
+        works = list(self.records)
+        if QUEUE:
+            for sub_works in grouped_slice(works, APPLY_RULES_CHUNK):
+                Work.__queue__.apply_default_rules(list(sub_works),
+                    self.start.children)
+        else:
+            Work.apply_default_rules(works, self.start.children)
+        return 'end'